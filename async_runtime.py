@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import signal
+import threading
+
+import paho.mqtt.client as mqtt
+
+
+class PahoAsyncio:
+    """Conecta un cliente paho al bucle de eventos en lugar de a su propio hilo de red.
+
+    paho avisa cuando abre o cierra el socket y cuando tiene datos por escribir; aquí eso se
+    traduce en add_reader/add_writer del bucle. Una tarea llama a `loop_misc()` cada segundo
+    (keepalive de MQTT) y reconecta con backoff si se pierde la conexión. Los avisos pueden
+    llegar desde otros hilos (p. ej. un publish desde un handler del bot) y se trasladan al
+    hilo del bucle.
+    """
+
+    def __init__(self, client, loop=None, max_backoff=60.0):
+        self.client = client
+        self.loop = loop or asyncio.get_running_loop()
+        self.max_backoff = max_backoff
+        self._loop_thread = threading.get_ident()
+        self._task = None
+        self._closing = False
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _call(self, function, *args):
+        if threading.get_ident() == self._loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    # Se usa el descriptor y no el socket: paho lo cierra justo después de avisar
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self.loop.remove_reader, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock.fileno())
+
+    async def connect(self, host, port, keepalive=60):
+        try:
+            # connect() resuelve el nombre y abre el socket de forma bloqueante
+            await self.loop.run_in_executor(None, self.client.connect, host, port, keepalive)
+        except OSError as e:
+            logging.error(f"Error en la conexión MQTT: {e}")  # _misc_loop seguirá reintentando
+        self._task = self.loop.create_task(self._misc_loop(), name="mqtt-misc")
+
+    async def _misc_loop(self):
+        backoff = 1.0
+        while not self._closing:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    backoff = 1.0
+                except OSError as e:
+                    logging.warning(f"No se pudo reconectar al broker MQTT: {e}. Reintento en {backoff:.0f} s")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+            await asyncio.sleep(1)
+
+    async def disconnect(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+        self.client.disconnect()
+
+
+async def serve(subscriber, shutdown_timeout=10.0):
+    """Ejecuta un MqttSubscriber creado con `asynchronous=True` en el bucle actual.
+
+    MQTT, el polling de AsyncTeleBot, la cola de salida de Telegram y los plazos de keep-alive
+    corren en este mismo bucle; los handlers del bot (que consultan la base de datos) van al
+    pool de hilos del bucle. Con SIGINT/SIGTERM se desconecta, se vacían la cola de Telegram y
+    las escrituras pendientes, y se guarda el estado de los dispositivos.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    subscriber.liveness.start()
+    if subscriber.sharding is not None:
+        subscriber.sharding.start()
+    polling = loop.create_task(subscriber.bot.start_async(), name="telegram-polling")
+    mqtt_client = PahoAsyncio(subscriber.client, loop)
+    await mqtt_client.connect(subscriber.broker, subscriber.port, 5)
+
+    try:
+        await stopping.wait()
+    finally:
+        logging.info("Deteniendo suscriptor MQTT...")
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+        polling.cancel()
+        await mqtt_client.disconnect()
+        subscriber.liveness.stop()
+        if subscriber.sharding is not None:
+            await asyncio.to_thread(subscriber.sharding.stop)
+        await subscriber.bot.outbox.aclose(shutdown_timeout)
+        close_session = getattr(subscriber.bot.bot, 'close_session', None)
+        if close_session is not None:
+            try:
+                await close_session()
+            except Exception as e:
+                logging.debug(f"Error cerrando la sesión de Telegram: {e}")
+        await asyncio.to_thread(subscriber.bot.states.close)
+        await asyncio.to_thread(subscriber.db_manager.close)  # Guarda los mensajes pendientes antes de salir
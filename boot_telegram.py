@@ -1,48 +1,112 @@
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
+import asyncio
 import os
+import threading
 import time
 import logging
+from timeseries import SeriesStore
+from scheduler import DeadlineScheduler
+from pending import PendingRequests
+from telegram_outbox import AsyncTelegramOutbox, TelegramOutbox
+from state import DeviceStateStore
+from metrics import REGISTRY
+
+try:
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:  # AsyncTeleBot necesita aiohttp; solo hace falta en el modo asyncio
+    AsyncTeleBot = None
 
 load_dotenv()  # Cargar variables de entorno (.env)
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", force=True)
+
+# Variables de sensor que se pueden consultar desde el menú: emoji y unidad
+SENSOR_UNITS = {
+    'temperatura': ("🌡️", "°C"),
+    'humedad': ("💧", "%"),
+}
+
+# Antigüedad máxima (s) de la última lectura para responder sin preguntar al dispositivo
+DEFAULT_MAX_AGE = {
+    'temperatura': 60.0,
+    'humedad': 60.0,
+    'led': 10.0,
+}
+
+CACHE_QUERIES = REGISTRY.counter('bot_cached_queries_total', 'Consultas del bot según se respondieron desde la última '
+                                 'lectura o preguntando al dispositivo', ['variable', 'result'])
 
 
 class BotTelegram:
-    def __init__(self, publish_function, db_manager):
-        self.publish_function = publish_function
+    def __init__(self, commands, db_manager, registry, sensor_device='nairo', request_timeout=5.0,
+                 telegram_client=None, state_store=None, asynchronous=False, users_page_size=10, max_age=None,
+                 background_refresh=False, subscribers_refresh_interval=60.0):
+        self.commands = commands  # CommandPublisher: órdenes hacia los dispositivos
         self.db = db_manager
+        self.registry = registry
+        self.sensor_device = sensor_device  # Dispositivo que tiene los sensores de temperatura y humedad
         self.token = os.getenv("TELEGRAM_API_TOKEN")
-        self.bot = telebot.TeleBot(self.token)
-
-        # Estados de los LEDs
-        self.led_states = {
-            'nairo': {'text': 'Desconocido', 'value': None, 'keep_alive': None, 'timestamp': None},
-            'alejandro': {'text': 'Desconocido', 'value': None, 'keep_alive': False, 'timestamp': None},
-        }
-
-        # Estados de sensores
-        self.sensor_states = {'temperatura': None, 'humedad': None}
+        # En modo asyncio el cliente es AsyncTeleBot y el bucle de eventos se fija en start_async
+        self.asynchronous = asynchronous
+        self.loop = None
+        if telegram_client is None and asynchronous and AsyncTeleBot is None:
+            raise RuntimeError("El modo asyncio necesita aiohttp (pip install aiohttp)")
+        self.bot = telegram_client or (AsyncTeleBot(self.token) if asynchronous else telebot.TeleBot(self.token))
+        # Todos los envíos pasan por la cola de salida; nadie espera a la API de Telegram
+        self.outbox = AsyncTelegramOutbox(self.bot) if asynchronous else TelegramOutbox(self.bot)
+
+        # Estado de cada dispositivo registrado (LED, keep-alive, última lectura de cada sensor)
+        self.states = state_store if state_store is not None else DeviceStateStore()
+        for device in self.registry.devices():
+            self.add_device(device)
+        self.registry.on_register(self.add_device)
+
+        # Historial en memoria por (dispositivo, variable) para consultas sin ir a la base de datos
+        self.history = SeriesStore()
+
+        # Última lectura conocida: si tiene menos de `max_age[variable]` segundos se responde con ella.
+        # Con `background_refresh`, pasada la mitad de ese plazo se pide otra en segundo plano
+        self.max_age = {**DEFAULT_MAX_AGE, **(max_age or {})}
+        self.background_refresh = background_refresh
 
         # Claves de callback para menús originales
         self.MENU_CALLBACKS = {
             'LED_MENU': 'submenu_leds',
-            'LED_NAIRO': 'led_nairo',
-            'LED_ALEJANDRO': 'led_alejandro',
+            'LED': 'led_',  # Prefijo: led_<dispositivo>
             'TEMPERATURA': 'temperatura',
             'HUMEDAD': 'humedad',
             'VOLVER': 'volver_menu',
         }
 
-        self.pending_led_status_request_chat_id = None
+        # Teclados fijos: se construyen una vez y se comparten entre respuestas (no modificarlos)
+        self._main_menus = {is_super: self._build_main_menu(is_super) for is_super in (False, True)}
+        self._kb_activacion = InlineKeyboardMarkup()
+        self._kb_activacion.add(InlineKeyboardButton("Solicitar activación", callback_data="REQUEST_ACTIVATION"))
+        # Menú de LEDs: (versión del estado, contenido mostrado, teclado); se rehace solo si cambia el contenido
+        self._leds_menu = (None, None, None)
+
+        # Listado de usuarios para administradores: tamaño de página y búsqueda activa de cada chat
+        self.users_page_size = users_page_size
+        self.user_searches = {}
+
+        # Motor de reglas cuyas alertas activas muestra /alertas; lo asigna quien lo crea (MqttSubscriber)
+        self.alerts = None
+        # Chats suscritos a alertas, en memoria: las alertas salen de la ruta de ingesta y no pueden
+        # esperar a Postgres. Un hilo los relee de la base de datos cada `subscribers_refresh_interval` s
+        self.alert_subscribers = frozenset()
+        threading.Thread(target=self._refresh_alert_subscribers, args=(subscribers_refresh_interval,),
+                         name="alert-subscribers", daemon=True).start()
+
+        # Peticiones a dispositivos en curso: (dispositivo o '*', request_data) -> chats que esperan respuesta
+        self.pending = PendingRequests(DeadlineScheduler(name="pending-requests"), timeout=request_timeout)
         self.register_handlers()
 
+    def add_device(self, device):
+        self.states.add(device.name, device.topic, device.command_topic)
+
     # Teclados para activación y gestión de usuarios
     def _kb_solicitar_activacion(self):
-        kb = InlineKeyboardMarkup()
-        kb.add(InlineKeyboardButton("Solicitar activación", callback_data="REQUEST_ACTIVATION"))
-        return kb
+        return self._kb_activacion
 
     def _kb_superusuario_para(self, user_id):
         kb = InlineKeyboardMarkup()
@@ -54,11 +118,41 @@ class BotTelegram:
 
     # Registro de handlers
     def register_handlers(self):
-        self.bot.message_handler(commands=['start', 'help'])(self.handle_start)
-        self.bot.message_handler(func=lambda msg: True)(self.handle_text_message)
-        self.bot.callback_query_handler(func=lambda call: True)(self.handle_callback)
+        wrap = self._in_thread if self.asynchronous else (lambda handler: handler)
+        self.bot.message_handler(commands=['start', 'help'])(wrap(self.handle_start))
+        self.bot.message_handler(commands=['historial'])(wrap(self.handle_history))
+        self.bot.message_handler(commands=['usuarios'])(wrap(self.handle_users))
+        self.bot.message_handler(commands=['alertas'])(wrap(self.handle_alerts))
+        self.bot.message_handler(func=lambda msg: True)(wrap(self.handle_text_message))
+        self.bot.callback_query_handler(func=lambda call: True)(wrap(self.handle_callback))
+
+    @staticmethod
+    def _in_thread(handler):
+        """Para AsyncTeleBot: el handler (que consulta la base de datos) corre en el pool de hilos del bucle."""
+        async def run(update):
+            await asyncio.to_thread(handler, update)
+        return run
+
+    def answer_callback_query(self, callback_id):
+        if self.loop is None:
+            self.bot.answer_callback_query(callback_id)
+        else:
+            # AsyncTeleBot devuelve una corrutina; el handler corre en otro hilo
+            asyncio.run_coroutine_threadsafe(self.bot.answer_callback_query(callback_id), self.loop)
 
     # Handlers de mensajes
+    def _require_active(self, message):
+        """Fila del usuario si su cuenta está activa; si no, le avisa y devuelve None."""
+        user = self.db.get_user(message.chat.id)
+        if not user or not user[2]:
+            self.outbox.send_message(
+                message.chat.id,
+                "🔒 Necesitas una cuenta activa para usar el bot.",
+                reply_markup=self._kb_solicitar_activacion()
+            )
+            return None
+        return user
+
     def handle_start(self, message):
         chat_id = message.chat.id
         user = self.db.get_user(chat_id)
@@ -66,7 +160,7 @@ class BotTelegram:
         if not user:
             name = message.from_user.username or message.from_user.first_name
             self.db.add_user(chat_id, name)
-            self.bot.send_message(
+            self.outbox.send_message(
                 chat_id,
                 "Bienvenido. Tu cuenta está _pendiente de activación_.",
                 parse_mode='Markdown',
@@ -77,37 +171,135 @@ class BotTelegram:
         _, is_super, is_active = user
 
         if not is_active:
-            self.bot.send_message(
+            self.outbox.send_message(
                 chat_id,
                 "🚫 Acceso denegado. Tu cuenta está desactivada.",
                 reply_markup=self._kb_solicitar_activacion()
             )
             return
 
-        kb = self.get_main_menu()
-        if is_super:
-            kb.row(InlineKeyboardButton("👥 Usuarios", callback_data="VIEW_USERS"))
-        self.bot.send_message(chat_id, "Bienvenido al sistema IoT 👋", reply_markup=kb)
+        self.outbox.send_message(chat_id, "Bienvenido al sistema IoT 👋", reply_markup=self.get_main_menu(is_super))
 
     def handle_text_message(self, message):
-        user = self.db.get_user(message.chat.id)
-        if not user or not user[2]:  # Verificar si está inactivo
-            self.bot.send_message(
-                message.chat.id,
-                "🔒 Necesitas una cuenta activa para usar el bot.",
-                reply_markup=self._kb_solicitar_activacion()
-            )
+        if not self._require_active(message):
             return
         self.handle_start(message)
 
+    def handle_history(self, message):
+        """/historial [variable] [horas] [dispositivo] — resumen del historial en memoria."""
+        if not self._require_active(message):
+            return
+
+        args = message.text.split()[1:]
+        variable = args[0].lower() if args else 'temperatura'
+        try:
+            horas = float(args[1]) if len(args) > 1 else 24
+        except ValueError:
+            self.outbox.send_message(message.chat.id, "Uso: /historial [variable] [horas] [dispositivo]")
+            return
+        device = args[2].lower() if len(args) > 2 else self.sensor_device
+
+        stats = self.history.stats(device, variable, horas * 3600)
+        if not stats:
+            disponibles = ", ".join(self.history.variables(device)) or "ninguna"
+            self.outbox.send_message(message.chat.id,
+                                  f"Sin datos de {variable} para {device} en las últimas {horas:g} h.\n"
+                                  f"Variables con historial: {disponibles}")
+            return
+
+        self.outbox.send_message(
+            message.chat.id,
+            f"📈 {variable.capitalize()} ({device}) — últimas {horas:g} h, {stats['count']} muestras\n"
+            f"Mín: {stats['min']:.2f}  Máx: {stats['max']:.2f}\n"
+            f"Media: {stats['mean']:.2f}  P50: {stats['p50']:.2f}  P95: {stats['p95']:.2f}"
+        )
+
+    def handle_users(self, message):
+        """/usuarios [texto] — listado paginado de usuarios, filtrado por nombre o id (solo superusuarios)."""
+        user = self._require_active(message)
+        if not user:
+            return
+        if not user[1]:
+            self.outbox.send_message(message.chat.id, "🚫 No tienes permisos para esta acción")
+            return
+
+        search = message.text.partition(' ')[2].strip()
+        if search:
+            self.user_searches[message.chat.id] = search
+        else:
+            self.user_searches.pop(message.chat.id, None)
+        self.send_users_page(message.chat.id)
+
+    def handle_alerts(self, message):
+        """/alertas [on|off] — suscripción a las alertas de sensores y listado de las activas."""
+        chat_id = message.chat.id
+        if not self._require_active(message):
+            return
+
+        arg = message.text.partition(' ')[2].strip().lower()
+        if arg in ('on', 'off'):
+            self.db.set_alert_subscription(chat_id, arg == 'on')
+            if arg == 'on':
+                self.alert_subscribers = self.alert_subscribers | {chat_id}
+            else:
+                self.alert_subscribers = self.alert_subscribers - {chat_id}
+            self.outbox.send_message(chat_id, "🔔 Suscrito a las alertas." if arg == 'on'
+                                     else "🔕 Ya no recibirás alertas.")
+            return
+        if arg:
+            self.outbox.send_message(chat_id, "Uso: /alertas [on|off]")
+            return
+
+        subscribed = chat_id in self.alert_subscribers
+        text = "🔔 Estás suscrito a las alertas." if subscribed else "🔕 No estás suscrito (/alertas on)."
+        active = self.alerts.active() if self.alerts is not None else []
+        if active:
+            text += "\n\nAlertas activas:\n" + "\n".join(
+                f"🚨 {alert.rule.name} — {alert.device}: {alert.metric:.2f} desde {self.timestamp_a_fecha(alert.ts)}"
+                for alert in active)
+        else:
+            text += "\n\nNo hay alertas activas."
+        self.outbox.send_message(chat_id, text)
+
+    def send_users_page(self, chat_id, after_id=None, before_id=None):
+        """Envía una página del listado de usuarios con botones para avanzar y retroceder."""
+        search = self.user_searches.get(chat_id)
+        rows, has_more = self.db.get_users_page(after_id, before_id, search, self.users_page_size)
+        if before_id is None:
+            has_prev, has_next = after_id is not None, has_more
+        else:
+            has_prev, has_next = has_more, True
+
+        kb = InlineKeyboardMarkup(row_width=1)
+        for uid, name, active in rows:
+            label = '✅' if active else '❌'
+            kb.add(InlineKeyboardButton(f"{name} ({uid}) — [{label}]",
+                                        callback_data=f"SET_ACTIVE_{uid}_{int(not active)}"))
+        nav = []
+        if rows and has_prev:
+            nav.append(InlineKeyboardButton("⬅️ Anteriores", callback_data=f"USERS_P_{rows[0][0]}"))
+        if rows and has_next:
+            nav.append(InlineKeyboardButton("Siguientes ➡️", callback_data=f"USERS_N_{rows[-1][0]}"))
+        if nav:
+            kb.row(*nav)
+        kb.add(InlineKeyboardButton("🏠 Menú principal", callback_data=self.MENU_CALLBACKS['VOLVER']))
+
+        if rows:
+            text = "Lista de usuarios (clic para alternar):"
+        else:
+            text = "No hay usuarios que mostrar."
+        if search:
+            text += f"\nBúsqueda: {search}"
+        self.outbox.send_message(chat_id, text, reply_markup=kb)
+
     def handle_callback(self, call):
-        self.bot.answer_callback_query(call.id)
+        self.answer_callback_query(call.id)
         data = call.data
         user_info = self.db.get_user(call.from_user.id)
 
         # Usuario no registrado
         if not user_info:
-            self.bot.send_message(call.from_user.id, "⚠️ Por favor, inicia el bot con /start")
+            self.outbox.send_message(call.from_user.id, "⚠️ Por favor, inicia el bot con /start")
             return
 
         _, is_super, is_active = user_info
@@ -115,66 +307,72 @@ class BotTelegram:
         # Permitir solicitud de activación incluso si está inactivo
         if data == "REQUEST_ACTIVATION":
             for su in self.db.get_superusers():
-                self.bot.send_message(
+                self.outbox.send_message(
                     su,
                     f"📢 El usuario @{call.from_user.username} (ID {call.from_user.id}) solicita activación.",
                     reply_markup=self._kb_superusuario_para(call.from_user.id)
                 )
-            self.bot.send_message(call.message.chat.id, "✅ Solicitud enviada a los administradores.")
+            self.outbox.send_message(call.message.chat.id, "✅ Solicitud enviada a los administradores.")
             return
 
         # Bloquear otras acciones si no está activo
         if not is_active:
-            self.bot.send_message(
+            self.outbox.send_message(
                 call.from_user.id,
                 "🔒 Tu cuenta está inactiva. Solicita activación:",
                 reply_markup=self._kb_solicitar_activacion()
             )
             return
 
-        # Listar usuarios + botón menú principal
-        if data == "VIEW_USERS":
-            kb = InlineKeyboardMarkup(row_width=1)
-            for uid, name, active in self.db.get_all_users():
-                label = '✅' if active else '❌'
-                kb.add(InlineKeyboardButton(f"{name} ({uid}) — [{label}]",
-                                            callback_data=f"SET_ACTIVE_{uid}_{int(not active)}"))
-            kb.add(InlineKeyboardButton("🏠 Menú principal", callback_data=self.MENU_CALLBACKS['VOLVER']))
-            self.bot.send_message(call.from_user.id, "Lista de usuarios (clic para alternar):", reply_markup=kb)
+        # Listar usuarios por páginas + botón menú principal (solo superusuarios)
+        if data == "VIEW_USERS" or data.startswith(("USERS_N_", "USERS_P_")):
+            if not is_super:
+                self.outbox.send_message(call.from_user.id, "🚫 No tienes permisos para esta acción")
+                return
+            if data == "VIEW_USERS":
+                self.user_searches.pop(call.from_user.id, None)
+                self.send_users_page(call.from_user.id)
+                return
+            try:
+                key = int(data[len("USERS_N_"):])
+            except ValueError:
+                logging.warning(f"Callback de paginación mal formado: {data}")
+                return
+            if data.startswith("USERS_N_"):
+                self.send_users_page(call.from_user.id, after_id=key)
+            else:
+                self.send_users_page(call.from_user.id, before_id=key)
             return
 
         # Callbacks originales del menú IoT
         if data == self.MENU_CALLBACKS['LED_MENU']:
-            self.pending_led_status_request_chat_id = call.message.chat.id
-            self.request_led_statuses()
-            self.bot.send_message(call.message.chat.id, "🔄 Pidiendo estado de los LEDs...")
+            if self.leds_fresh():
+                self.outbox.send_message(call.message.chat.id, "Selecciona un LED:", reply_markup=self.get_leds_menu())
+            else:
+                self.outbox.send_message(call.message.chat.id, "🔄 Pidiendo estado de los LEDs...")
+                self.request_led_statuses(call.message.chat.id)
 
         elif data == self.MENU_CALLBACKS['VOLVER']:
             chat_id = call.message.chat.id
             _, is_super, _ = self.db.get_user(chat_id)
-            kb = self.get_main_menu()
-            if is_super:
-                kb.row(InlineKeyboardButton("👥 Usuarios", callback_data="VIEW_USERS"))
-            self.bot.send_message(chat_id, "Selecciona una opción:", reply_markup=kb)
+            self.outbox.send_message(chat_id, "Selecciona una opción:", reply_markup=self.get_main_menu(is_super))
 
-        elif data in (self.MENU_CALLBACKS['LED_NAIRO'], self.MENU_CALLBACKS['LED_ALEJANDRO']):
-            name = 'nairo' if data == self.MENU_CALLBACKS['LED_NAIRO'] else 'alejandro'
-            self.action_leds(call.message.chat.id, name)
+        elif data.startswith(self.MENU_CALLBACKS['LED']):
+            name = data[len(self.MENU_CALLBACKS['LED']):]
+            if name in self.states:
+                self.action_leds(call.message.chat.id, name)
 
-        elif data == self.MENU_CALLBACKS['TEMPERATURA']:
-            self.pending_led_status_request_chat_id = call.message.chat.id
-            self.bot.send_message(call.message.chat.id, "🌡️ Consultando temperatura...")
-            self.request_sensor_status('temperatura')
-
-        elif data == self.MENU_CALLBACKS['HUMEDAD']:
-            self.pending_led_status_request_chat_id = call.message.chat.id
-            self.bot.send_message(call.message.chat.id, "💧 Consultando humedad...")
-            self.request_sensor_status('humedad')
+        elif data in (self.MENU_CALLBACKS['TEMPERATURA'], self.MENU_CALLBACKS['HUMEDAD']):
+            variable = data
+            if not self.reply_from_cache(variable, call.message.chat.id):
+                emoji, _ = SENSOR_UNITS[variable]
+                self.outbox.send_message(call.message.chat.id, f"{emoji} Consultando {variable}...")
+                self.request_sensor_status(variable, call.message.chat.id)
 
         # Activar/Desactivar usuario (solo superusuarios)
         if data.startswith("SET_ACTIVE_"):
             if not is_super:
-                self.bot.send_message(call.from_user.id, "🚫 No tienes permisos para esta acción")
+                self.outbox.send_message(call.from_user.id, "🚫 No tienes permisos para esta acción")
                 return
 
             try:
@@ -187,112 +385,190 @@ class BotTelegram:
 
             self.db.update_active(uid, flag)
             estado = "activo" if flag else "inactivo"
-            self.bot.send_message(call.from_user.id, f"Usuario {uid} ahora está *{estado}*.", parse_mode='Markdown')
+            self.outbox.send_message(call.from_user.id, f"Usuario {uid} ahora está *{estado}*.", parse_mode='Markdown')
 
-            try:
-                self.bot.send_message(uid, f"Tu cuenta ha sido *{estado}* por el administrador.", parse_mode='Markdown')
-            except Exception as e:
-                logging.error(f"Error notificando al usuario {uid}: {e}")
+            self.outbox.send_message(uid, f"Tu cuenta ha sido *{estado}* por el administrador.", parse_mode='Markdown')
 
     # ... (El resto de los métodos permanecen igual: get_main_menu, get_leds_menu, request_led_statuses, etc.)
     # Mantener sin cambios los métodos restantes de la clase BotTelegram
 
-    def get_main_menu(self):
+    def _build_main_menu(self, is_super):
         kb = InlineKeyboardMarkup(row_width=2)
         kb.add(
             InlineKeyboardButton("💡 LEDs", callback_data=self.MENU_CALLBACKS['LED_MENU']),
             InlineKeyboardButton("🌡️ Temperatura", callback_data=self.MENU_CALLBACKS['TEMPERATURA']),
             InlineKeyboardButton("💧 Humedad", callback_data=self.MENU_CALLBACKS['HUMEDAD'])
         )
+        if is_super:
+            kb.row(InlineKeyboardButton("👥 Usuarios", callback_data="VIEW_USERS"))
         return kb
 
+    def get_main_menu(self, is_super=False):
+        return self._main_menus[bool(is_super)]
+
     def get_leds_menu(self):
-        kb = InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            InlineKeyboardButton(f"💡 LED Nairo ({self.led_states['nairo']['text']})",
-                                 callback_data=self.MENU_CALLBACKS['LED_NAIRO']),
-            InlineKeyboardButton(f"💡 LED Alejandro ({self.led_states['alejandro']['text']})",
-                                 callback_data=self.MENU_CALLBACKS['LED_ALEJANDRO'])
-        )
-        kb.add(InlineKeyboardButton("🏠 Menú principal", callback_data=self.MENU_CALLBACKS['VOLVER']))
+        """Teclado de LEDs en caché: solo se reconstruye si cambia algún nombre o estado de LED."""
+        version = self.states.version  # Antes de la copia: un cambio concurrente invalidará la siguiente llamada
+        cached_version, content, kb = self._leds_menu
+        if version == cached_version:
+            return kb
+        current = tuple((name, state.led_text) for name, state in self.states.snapshot().items())
+        if current != content:
+            kb = InlineKeyboardMarkup(row_width=2)
+            kb.add(*[
+                InlineKeyboardButton(f"💡 LED {name.capitalize()} ({led_text})",
+                                     callback_data=f"{self.MENU_CALLBACKS['LED']}{name}")
+                for name, led_text in current
+            ])
+            kb.add(InlineKeyboardButton("🏠 Menú principal", callback_data=self.MENU_CALLBACKS['VOLVER']))
+        self._leds_menu = (version, current, kb)
         return kb
 
-    def request_led_statuses(self):
-        for topic in ("AaN", "NaA"):
-            self.publish_function(topic=topic, message={'id': 3, 'action': 'request', 'request_data': 'estado_led'})
-
-    def request_sensor_status(self, variable: str):
-        if self.led_states['nairo']['keep_alive']:
-            self.publish_function(topic="AaN",
-                                  message={'id': 3, 'action': 'request', 'request_data': f'estado_{variable}'})
-        else:
-            self.bot.send_message(
-                self.pending_led_status_request_chat_id,
-                f"Dispositivo desconectado - Última interacción: {self.timestamp_a_fecha(self.led_states['nairo']['timestamp'])}"
+    def _fresh(self, state, variable):
+        """Edad de la última lectura si está dentro de su límite, o None si hay que preguntar al dispositivo."""
+        value, ts = state.sensor(variable)
+        if ts is None:
+            return None
+        age = time.time() - ts
+        return age if age <= self.max_age.get(variable, 0.0) else None
+
+    def leds_fresh(self):
+        """True si el LED de cada dispositivo conectado se leyó hace menos de `max_age['led']`."""
+        ages = []
+        for state in self.states.snapshot().values():
+            if state.keep_alive:
+                age = self._fresh(state, 'led')
+                if age is None:
+                    CACHE_QUERIES.inc(variable='led', result='miss')
+                    return False
+                ages.append(age)
+        CACHE_QUERIES.inc(variable='led', result='hit')
+        if self.background_refresh and ages and max(ages) > self.max_age['led'] / 2:
+            self.request_led_statuses()
+        return True
+
+    def reply_from_cache(self, variable, chat_id):
+        """Responde con la última lectura si es reciente. Devuelve False si hay que preguntar al dispositivo."""
+        state = self.states.get(self.sensor_device)
+        age = self._fresh(state, variable) if state is not None else None
+        if age is None:
+            CACHE_QUERIES.inc(variable=variable, result='miss')
+            return False
+        CACHE_QUERIES.inc(variable=variable, result='hit')
+        value, _ = state.sensor(variable)
+        self.outbox.send_message(chat_id, self._sensor_text(variable, value), reply_markup=self.get_main_menu())
+        if self.background_refresh and age > self.max_age[variable] / 2:
+            self.request_sensor_status(variable)  # Sin chat: solo renueva la lectura
+        return True
+
+    def _sensor_text(self, variable, value):
+        emoji, unidad = SENSOR_UNITS[variable]
+        return f"{emoji} {variable.capitalize()}: {value} {unidad}\n\nSelecciona otra opción:"
+
+    def request_led_statuses(self, chat_id=None):
+        # Si ya hay una consulta de LEDs en vuelo, el chat espera esa misma respuesta
+        corr_id, new = self.pending.add(('*', 'estado_led'), chat_id, self.on_request_timeout)
+        if new:
+            # Una sola orden serializada para toda la flota
+            self.commands.broadcast({'id': 3, 'action': 'request', 'request_data': 'estado_led', 'corr': corr_id})
+
+    def request_sensor_status(self, variable: str, chat_id=None):
+        state = self.states.get(self.sensor_device)
+        device = self.registry.get(self.sensor_device)
+        if state and state.keep_alive and device and device.command_topic:
+            request_data = f'estado_{variable}'
+            corr_id, new = self.pending.add((device.name, request_data), chat_id, self.on_request_timeout)
+            if new:
+                self.commands.publish(device.command_topic,
+                                      {'id': 3, 'action': 'request', 'request_data': request_data, 'corr': corr_id})
+        elif chat_id is not None:
+            self.outbox.send_message(
+                chat_id,
+                f"Dispositivo desconectado - Última interacción: {self.timestamp_a_fecha(state and state.last_seen)}"
             )
 
+    def on_request_timeout(self, key, chats):
+        device, request_data = key
+        logging.warning(f"Sin respuesta a {request_data} de {device}. Chats en espera: {len(chats)}")
+        for chat_id in chats:
+            self.show_main_menu(chat_id, "⏱️ El dispositivo no respondió a tiempo. Selecciona otra opción:")
+
     def update_keep_alive(self, name, status):
-        if name in self.led_states:
-            self.led_states[name]['keep_alive'] = status
-            if status:
-                self.led_states[name]['timestamp'] = time.time()
-
-    def update_led_status(self, name, status):
-        if name in self.led_states:
-            self.led_states[name]['text'] = "Encendido" if status else "Apagado"
-            self.led_states[name]['value'] = status
-            if self.pending_led_status_request_chat_id:
-                self.bot.send_message(
-                    self.pending_led_status_request_chat_id,
+        self.states.set_keep_alive(name, status)
+
+    def update_led_status(self, name, status, corr_id=None):
+        if self.states.set_led(name, status) is not None:
+            self.history.record(name, 'led', 1 if status else 0)
+            for chat_id in self.pending.resolve(('*', 'estado_led'), corr_id):
+                self.outbox.send_message(
+                    chat_id,
                     "✅ Estado actualizado. Selecciona un LED:",
                     reply_markup=self.get_leds_menu()
                 )
-                self.pending_led_status_request_chat_id = None
-
-    def update_sensor_status(self, variable, value):
-        if variable in self.sensor_states:
-            self.sensor_states[variable] = value
-            if self.pending_led_status_request_chat_id:
-                emoji = "🌡️" if variable == 'temperatura' else "💧"
-                unidad = "°C" if variable == 'temperatura' else "%"
-                self.bot.send_message(
-                    self.pending_led_status_request_chat_id,
-                    f"{emoji} {variable.capitalize()}: {value} {unidad}\n\nSelecciona otra opción:",
-                    reply_markup=self.get_main_menu()
-                )
-                self.pending_led_status_request_chat_id = None
+
+    def update_sensor_status(self, variable, value, device=None, corr_id=None):
+        device = device or self.sensor_device
+        self.history.record(device, variable, value)
+        self.states.set_sensor(device, variable, value)
+        if variable in SENSOR_UNITS:
+            for chat_id in self.pending.resolve((device, f'estado_{variable}'), corr_id):
+                self.outbox.send_message(chat_id, self._sensor_text(variable, value), reply_markup=self.get_main_menu())
 
     def show_main_menu(self, chat_id, text):
-        self.bot.send_message(chat_id, text, reply_markup=self.get_main_menu())
+        self.outbox.send_message(chat_id, text, reply_markup=self.get_main_menu())
 
     def send_action_response(self, chat_id, text):
-        self.bot.send_message(chat_id, text)
+        self.outbox.send_message(chat_id, text)
         self.show_main_menu(chat_id, "Selecciona otra opción:")
 
     def action_leds(self, chat_id, led_name):
-        if self.led_states[led_name]['keep_alive']:
-            self.publish_function(
-                topic="AaN",
-                message={'id': 3, 'action': 'response', 'dato_led': 0 if self.led_states[led_name]['value'] else 1}
-            )
-            estado = "Apagado" if self.led_states[led_name]['value'] else "Encendido"
+        device = self.registry.get(led_name)
+        state = self.states.get(led_name)
+        if state.keep_alive and device and device.command_topic:
+            self.commands.publish(device.command_topic,
+                                  {'id': 3, 'action': 'response', 'dato_led': 0 if state.led else 1})
+            # El LED va a cambiar: la lectura en caché ya no vale y el menú debe volver a preguntar
+            self.states.expire_reading(led_name, 'led')
+            estado = "Apagado" if state.led else "Encendido"
             self.send_action_response(chat_id, f"🔆 LED {led_name.capitalize()} {estado}")
         else:
             self.send_action_response(
                 chat_id,
-                f"Dispositivo desconectado - Última interacción: {self.timestamp_a_fecha(self.led_states[led_name]['timestamp'])}"
+                f"Dispositivo desconectado - Última interacción: {self.timestamp_a_fecha(state.last_seen)}"
             )
 
+    def _refresh_alert_subscribers(self, interval):
+        while True:
+            try:
+                self.alert_subscribers = frozenset(self.db.get_alert_subscribers())
+            except Exception as e:
+                logging.error(f"No se pudieron leer las suscripciones a alertas: {e}")
+            time.sleep(interval)
+
+    def alert_chats(self):
+        """Chats suscritos a las alertas más los que esperan respuesta de algún dispositivo (sin consultas)."""
+        return list(dict.fromkeys((*self.alert_subscribers, *self.pending.waiting_chats())))
+
+    def send_alert(self, alert):
+        """Notifica una transición del motor de reglas (ver rules.py) a los chats suscritos."""
+        if alert.active:
+            mensaje = (f"🚨 {alert.rule.name}: {alert.device} — {alert.rule.describe()}\n"
+                       f"Valor actual: {alert.metric:.2f}")
+        else:
+            mensaje = f"✅ {alert.rule.name} resuelta: {alert.device} — valor actual {alert.metric:.2f}"
+        for chat in self.alert_chats():
+            self.outbox.send_message(chat, mensaje)  # Sin Markdown: nombres de reglas y dispositivos van tal cual
+
     def alerta_todos_desconectados(self):
         mensaje = "⚠️ *Todos los dispositivos están desconectados.*\n\n"
-        for nombre, datos in self.led_states.items():
-            ultima = self.timestamp_a_fecha(datos['timestamp']) if datos['timestamp'] else "Sin registro"
+        for nombre, state in self.states.snapshot().items():
+            ultima = self.timestamp_a_fecha(state.last_seen)
             mensaje += f"🔌 *{nombre.capitalize()}*: última señal {ultima}\n"
-        chat = self.pending_led_status_request_chat_id or None
-        if chat:
-            self.send_action_response(chat, mensaje)
-        else:
+        chats = self.alert_chats()
+        if not chats:
             logging.warning("No hay chat para alerta de desconexión.")
+        for chat in chats:
+            self.send_action_response(chat, mensaje)
 
     def timestamp_a_fecha(self, timestamp):
         if not timestamp:
@@ -301,4 +577,9 @@ class BotTelegram:
         return f"{tm.tm_year}/{tm.tm_mon:02d}/{tm.tm_mday:02d} {tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
 
     def start(self):
-        self.bot.infinity_polling()
\ No newline at end of file
+        self.bot.infinity_polling()
+
+    async def start_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.outbox.start()
+        await self.bot.infinity_polling()
\ No newline at end of file
@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Caché en memoria con expiración por entrada (TTL) y desalojo LRU, segura entre hilos.
+
+    También guarda resultados `None` (caché negativa), así un usuario no registrado no
+    consulta la base de datos en cada mensaje.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expira_en, valor)
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, loader):
+        """Devuelve el valor en caché o lo obtiene con `loader()` y lo guarda."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            version = self._version
+
+        value = loader()
+
+        with self._lock:
+            # Si hubo una invalidación mientras se cargaba, el valor puede estar obsoleto
+            if version == self._version:
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._version += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._version += 1
+
+    def __len__(self):
+        return len(self._data)
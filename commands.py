@@ -0,0 +1,224 @@
+import fnmatch
+import functools
+import logging
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+from messages import dumps
+from metrics import REGISTRY
+
+COMMANDS_PUBLISHED = REGISTRY.counter('mqtt_commands_published_total', 'Órdenes publicadas hacia los dispositivos')
+COMMANDS_DROPPED = REGISTRY.counter('mqtt_commands_dropped_total', 'Órdenes descartadas sin publicar', ['reason'])
+COMMAND_ACK_SECONDS = REGISTRY.histogram('mqtt_command_ack_seconds', 'Tiempo desde publish hasta la confirmación del broker')
+
+_CORR = "\x00corr\x00"  # Marcador del corr en las plantillas
+
+
+@functools.lru_cache(maxsize=256)
+def _template(items):
+    """Serializa una orden una sola vez; si lleva corr devuelve (prefijo, sufijo) alrededor de su valor."""
+    message = dict(items)
+    if 'corr' not in message:
+        return dumps(message), None
+    marker = dumps(_CORR)
+    prefix, _, suffix = dumps({**message, 'corr': _CORR}).partition(marker)
+    return prefix, suffix
+
+
+def render(message):
+    """Bytes de la orden. Las que solo difieren en el corr comparten plantilla y solo se serializa el corr."""
+    corr = message.get('corr')
+    try:
+        prefix, suffix = _template(tuple((k, _CORR if k == 'corr' else v) for k, v in message.items()))
+    except TypeError:  # Valores no hashables (listas, dicts): sin caché
+        return dumps(message)
+    return prefix if suffix is None else prefix + dumps(corr) + suffix
+
+
+class CommandPublisher:
+    """Publica órdenes a dispositivos, grupos o patrones con control de flujo.
+
+    - Destinos: nombre de dispositivo, grupo (`add_group`) o patrón tipo `sensor-*`; `'*'` son
+      todos. La orden se serializa una vez y se publica en cada tópico de órdenes distinto. Si
+      los dispositivos escuchan además un `broadcast_topic`, `broadcast` es una sola publicación.
+    - QoS configurable con una ventana de `max_inflight` publicaciones sin confirmar; las
+      confirmaciones llegan por `on_publish` (que hay que conectar al cliente).
+    - Sin conexión (o con la ventana llena) las órdenes esperan en una cola acotada y se envían
+      al reconectar (`replay`); las que esperan más de `max_age` segundos se descartan.
+    """
+
+    def __init__(self, client, registry, qos=1, max_inflight=100, max_queued=10000, max_age=30.0,
+                 ack_timeout=30.0, broadcast_topic=None):
+        self.client = client
+        self.registry = registry
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.max_age = max_age
+        self.ack_timeout = ack_timeout
+        self.broadcast_topic = broadcast_topic
+        self.groups = {}
+
+        # Nunca se llama a client.publish() con este lock tomado: paho entrega los PUBACK a
+        # on_publish con su propio lock de salida tomado y el orden inverso provocaría un interbloqueo
+        self._lock = threading.Lock()
+        self._queued = deque(maxlen=max_queued)  # (tópico, payload, instante en que se encoló)
+        self._inflight = {}  # mid -> instante de publicación
+        self._early_acks = {}  # mid -> instante: confirmaciones que llegaron antes de que publish() devolviera el mid
+        self._reserved = 0  # Huecos de la ventana apartados para publicaciones en curso
+        self._draining = False
+        if hasattr(client, 'max_inflight_messages_set'):
+            client.max_inflight_messages_set(max(max_inflight, 20))
+
+    # Destinos
+    def add_group(self, name, devices):
+        self.groups[name] = list(devices)
+
+    def targets(self, selector):
+        """Dispositivos que corresponden a un nombre, un grupo o un patrón."""
+        if selector in self.groups:
+            return [d for d in map(self.registry.get, self.groups[selector]) if d is not None]
+        device = self.registry.get(selector)
+        if device is not None:
+            return [device]
+        return [d for d in self.registry.devices() if fnmatch.fnmatchcase(d.name, selector)]
+
+    def send(self, selector, message):
+        """Publica la orden a cada tópico de órdenes distinto de los destinos. Devuelve cuántos tópicos."""
+        topics = dict.fromkeys(d.command_topic for d in self.targets(selector) if d.command_topic)
+        payload = render(message)
+        for topic in topics:
+            self.publish_payload(topic, payload)
+        return len(topics)
+
+    def broadcast(self, message):
+        if self.broadcast_topic:
+            self.publish_payload(self.broadcast_topic, render(message))
+            return 1
+        return self.send('*', message)
+
+    # Publicación
+    def publish(self, topic, message):
+        return self.publish_payload(topic, render(message))
+
+    def publish_payload(self, topic, payload):
+        """Publica ya serializado. Devuelve False si la orden quedó en cola."""
+        with self._lock:
+            direct = not self._queued and not self._draining and self._reserve()
+            if not direct:
+                self._enqueue(topic, payload)
+        if direct:
+            sent = self._send(topic, payload, time.monotonic())
+        else:
+            sent = False
+        self._drain()
+        return sent
+
+    def _reserve(self):
+        """Aparta un hueco de la ventana si hay conexión y sitio (con el lock tomado)."""
+        if not self.client.is_connected():
+            return False
+        limit = time.monotonic() - self.ack_timeout
+        if len(self._inflight) + self._reserved >= self.max_inflight:
+            # Confirmaciones que nunca llegarán (p. ej. QoS 0 perdido al desconectar) no bloquean la ventana
+            for mid in [mid for mid, sent in self._inflight.items() if sent < limit]:
+                del self._inflight[mid]
+        for mid in [mid for mid, acked in self._early_acks.items() if acked < limit]:
+            del self._early_acks[mid]
+        if len(self._inflight) + self._reserved >= self.max_inflight:
+            return False
+        self._reserved += 1
+        return True
+
+    def _enqueue(self, topic, payload):
+        if len(self._queued) == self._queued.maxlen:
+            COMMANDS_DROPPED.inc(reason='overflow')
+        self._queued.append((topic, payload, time.monotonic()))
+
+    def _send(self, topic, payload, queued_at):
+        """Publica fuera del lock un mensaje con hueco reservado. Devuelve False si no salió."""
+        try:
+            info = self.client.publish(topic, payload, qos=self.qos)
+        except Exception:
+            with self._lock:
+                self._reserved -= 1
+            raise
+        with self._lock:
+            self._reserved -= 1
+            if info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos == 0:
+                self._queued.appendleft((topic, payload, queued_at))
+                return False
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                failed = True
+            else:
+                failed = False
+                # Si la confirmación ya llegó (p. ej. paho escribió el paquete dentro de publish()) no queda en vuelo
+                if self._early_acks.pop(info.mid, None) is None:
+                    self._inflight[info.mid] = time.monotonic()
+        if failed:
+            # Con QoS > 0 y sin conexión paho conserva el mensaje y lo envía al reconectar
+            COMMANDS_DROPPED.inc(reason='error')
+            logging.warning(f"No se pudo publicar la orden en {topic}. Código de error: {info.rc}")
+            return False
+        COMMANDS_PUBLISHED.inc()
+        logging.info("Orden publicada en %s: %s", topic, payload,
+                     extra={'category': 'mqtt.publish', 'key': topic})
+        return True
+
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        """Callback de paho: el broker confirmó `mid` (o, con QoS 0, se escribió en el socket).
+
+        paho lo llama con su lock de salida tomado: aquí solo se anota la confirmación bajo el
+        lock propio y el vaciado de la cola ocurre después, ya sin él.
+        """
+        with self._lock:
+            sent = self._inflight.pop(mid, None)
+            if sent is None:
+                self._early_acks[mid] = time.monotonic()
+        if sent is not None:
+            COMMAND_ACK_SECONDS.observe(time.monotonic() - sent)
+        self._drain()
+
+    def replay(self):
+        """Envía lo encolado (p. ej. desde on_connect); lo que caduque se descarta."""
+        self._drain()
+
+    def _drain(self):
+        """Vacía la cola en orden. Un solo hilo vacía a la vez; el lock solo se toma para sacar cada orden."""
+        expired = 0
+        with self._lock:
+            if self._draining:
+                return  # Otro hilo (o este mismo, desde on_publish dentro de publish) ya está vaciando
+            self._draining = True
+        try:
+            while True:
+                with self._lock:
+                    limit = time.monotonic() - self.max_age
+                    while self._queued and self._queued[0][2] < limit:
+                        self._queued.popleft()
+                        expired += 1
+                    if not self._queued or not self._reserve():
+                        # Se suelta la marca en la misma sección que comprueba la cola: lo que se
+                        # encole después lo vaciará quien lo encoló
+                        self._draining = False
+                        break
+                    topic, payload, queued_at = self._queued.popleft()
+                if not self._send(topic, payload, queued_at):
+                    with self._lock:
+                        self._draining = False
+                    break
+        except BaseException:
+            with self._lock:
+                self._draining = False
+            raise
+        if expired:
+            COMMANDS_DROPPED.inc(expired, reason='expired')
+            logging.warning(f"{expired} órdenes descartadas por esperar más de {self.max_age:g} s sin conexión.")
+
+    def queued(self):
+        return len(self._queued)
+
+    def inflight(self):
+        return len(self._inflight)
@@ -1,90 +1,592 @@
 import psycopg2
+from psycopg2 import extensions, pool, sql
+from psycopg2.extras import Json, execute_values
+import itertools
 import logging
-from datetime import datetime
+import queue
+import threading
+import time
+from datetime import date, datetime, timedelta
+from cache import TTLCache
+from metrics import REGISTRY
+from spool import Spool
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", force=True)
+# Telemetría tipada, particionada por día. El índice (device, variable, ts) se crea en la tabla
+# padre y Postgres lo replica en cada partición. telemetry_hourly guarda el resumen de las
+# particiones que ya se eliminaron por retención.
+TELEMETRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS public.telemetry (
+    ts       timestamptz      NOT NULL,
+    device   text             NOT NULL,
+    variable text             NOT NULL,
+    value    double precision,
+    payload  jsonb
+) PARTITION BY RANGE (ts);
+
+CREATE INDEX IF NOT EXISTS telemetry_device_variable_ts_idx ON public.telemetry (device, variable, ts);
+
+CREATE TABLE IF NOT EXISTS public.telemetry_hourly (
+    bucket   timestamptz      NOT NULL,
+    device   text             NOT NULL,
+    variable text             NOT NULL,
+    samples  bigint           NOT NULL,
+    min      double precision,
+    max      double precision,
+    avg      double precision,
+    PRIMARY KEY (device, variable, bucket)
+);
+"""
+
+TELEMETRY_PARTITION_PREFIX = "telemetry_"
+
+# Marcas de los lotes del spool ya aplicados: se insertan en la misma transacción que sus filas
+SPOOL_MARKERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS public.spool_batches (
+    batch_id    text        PRIMARY KEY,
+    replayed_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+# Chats suscritos a las alertas del motor de reglas (ver rules.py)
+ALERT_SUBSCRIPTIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS public.alert_subscriptions (
+    chat_id    bigint      PRIMARY KEY,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+DB_BATCH_SECONDS = REGISTRY.histogram('db_batch_write_seconds', 'Duración de cada escritura por lotes', ['writer'])
+DB_BATCH_SIZE = REGISTRY.histogram('db_batch_size', 'Filas por lote escrito', ['writer'],
+                                   buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+DB_BATCH_ERRORS = REGISTRY.counter('db_batch_errors_total', 'Lotes que fallaron al escribirse', ['writer'])
+DB_DROPPED = REGISTRY.counter('db_queue_dropped_total', 'Registros descartados por cola llena', ['writer'])
+
+
+class MessageBatchWriter:
+    """Cola acotada que un hilo escritor vacía en lotes (por tamaño o por antigüedad)."""
+
+    _STOP = object()
+
+    def __init__(self, flush_function, max_batch=500, max_delay=1.0, max_queue=10000, put_timeout=0.5,
+                 name="db-writer"):
+        self.flush_function = flush_function
+        self.name = name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def enqueue(self, item):
+        """Encola un registro. Si la cola está llena espera `put_timeout` segundos (backpressure) y luego lo descarta."""
+        try:
+            self.queue.put(item, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            DB_DROPPED.inc(writer=self.name)
+            logging.warning("Cola de escritura %s llena. Mensajes descartados: %d", self.name, self.dropped,
+                            extra={'category': 'db.batch', 'key': (self.name, 'dropped')})
+            return False
+
+    def stop(self, timeout=None):
+        """Detiene el hilo escritor tras vaciar lo pendiente en la cola."""
+        self.queue.put(self._STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            if stop:
+                return
+
+    def _flush(self, batch):
+        DB_BATCH_SIZE.observe(len(batch), writer=self.name)
+        try:
+            with DB_BATCH_SECONDS.time(writer=self.name):
+                self.flush_function(batch)
+        except Exception as e:
+            DB_BATCH_ERRORS.inc(writer=self.name)
+            logging.error(f"Error al guardar lote de {len(batch)} mensajes: {e}")
 
 
 class DatabaseManager:
-    def __init__(self, db_config):
+    """Acceso a Postgres a través de un pool de conexiones compartido por todos los hilos.
+
+    Cada operación toma una conexión del pool, la valida y la devuelve al terminar. Si la
+    conexión se cae se descarta y la operación se reintenta con backoff exponencial.
+    """
+
+    def __init__(self, db_config, min_connections=1, max_connections=5, max_retries=3, retry_backoff=0.5,
+                 health_check_interval=30.0, batch_size=500, batch_delay=1.0, queue_size=10000,
+                 user_cache_size=1024, user_cache_ttl=60.0, telemetry_retention_days=30,
+                 maintenance_interval=3600.0, spool_path=None, spool_max_bytes=512 * 2 ** 20):
         self.db_config = db_config
-        self.connection = self.connect_to_db()
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.health_check_interval = health_check_interval
+
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)  # ThreadedConnectionPool no bloquea si se agota
+        self._last_used = {}
+
+        # Caché de usuarios y permisos; se invalida en add_user y update_active
+        self.user_cache = TTLCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+
+        self.connect_to_db()
+
+        # Spool local: lo que no se puede escribir en Postgres (caído o en mantenimiento) se guarda
+        # en disco y un hilo lo reenvía al volver, en bloques grandes y una sola vez
+        self.spool = None
+        self._spool_markers_ready = False
+        self._alert_schema_ready = False
+
+        self.writer = MessageBatchWriter(self._spooling("logsESP", self.save_messages), max_batch=batch_size,
+                                         max_delay=batch_delay, max_queue=queue_size, name="logsESP")
+
+        # Telemetría: su propio escritor por lotes y mantenimiento periódico (particiones y retención)
+        self.telemetry_retention_days = telemetry_retention_days
+        self._partitions = set()
+        self._cursor_names = itertools.count()
+        self.telemetry_writer = MessageBatchWriter(self._spooling("telemetry", self.save_telemetry), max_batch=batch_size,
+                                                   max_delay=batch_delay, max_queue=queue_size, name="telemetry")
+        if spool_path:
+            self.spool = Spool(spool_path, self.replay_spooled, max_bytes=spool_max_bytes)
+
+        # Con `maintenance_interval=None` no se arranca el mantenimiento (p. ej. en los workers de
+        # ingesta, donde ya lo hace el proceso principal); las particiones se crean igual al escribir
+        self._stop_maintenance = threading.Event()
+        if maintenance_interval is not None:
+            threading.Thread(target=self._maintenance_loop, args=(maintenance_interval,),
+                             name="db-maintenance", daemon=True).start()
 
     def connect_to_db(self):
         try:
-            conn = psycopg2.connect(
-                dbname=self.db_config["dbname"],
-                user=self.db_config["user"],
-                password=self.db_config["password"],
-                host=self.db_config["host"],
-                port=self.db_config["port"]
-            )
-            logging.info("Conexión a la base de datos establecida correctamente.")
-            return conn
+            return self._ensure_pool()
         except Exception as e:
             logging.error(f"Error al conectar a la base de datos: {e}")
             return None
 
-    def get_user(self, chat_id):
-        cur = self.connection.cursor()
+    def _ensure_pool(self):
+        with self._pool_lock:
+            if self.pool is None:
+                self.pool = pool.ThreadedConnectionPool(
+                    self.min_connections,
+                    self.max_connections,
+                    dbname=self.db_config["dbname"],
+                    user=self.db_config["user"],
+                    password=self.db_config["password"],
+                    host=self.db_config["host"],
+                    port=self.db_config["port"]
+                )
+                logging.info("Conexión a la base de datos establecida correctamente.")
+            return self.pool
 
-        cur.execute('SELECT name_user, "is_superUser", is_active FROM public.users WHERE id = %s', (chat_id,))
+    def _checkout(self):
+        db_pool = self._ensure_pool()
+        while True:
+            conn = db_pool.getconn()
+            if self._is_healthy(conn):
+                return conn
+            logging.warning("Conexión inválida en el pool. Se descarta.")
+            self._discard(conn)
 
+    def _is_healthy(self, conn):
+        if conn.closed or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        # Solo se hace ping a conexiones que llevan un rato sin usarse
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
 
-        row = cur.fetchone()
-        cur.close()
-
-        return row  # (name_user, bool, bool) o None
+    def _release(self, conn):
+        self._last_used[id(conn)] = time.monotonic()
+        self.pool.putconn(conn)
 
-    def add_user(self, chat_id, name):
-        cur = self.connection.cursor()
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        try:
+            self.pool.putconn(conn, close=True)
+        except Exception as e:
+            logging.debug(f"Error al descartar conexión: {e}")
 
-        cur.execute(
-            'INSERT INTO public.users (id, name_user, "is_superUser", is_active) VALUES (%s, %s, FALSE, FALSE)',
-            (chat_id, name)
-        )
-        self.connection.commit()
-        cur.close()
+    def _run(self, operation):
+        """Ejecuta `operation(cursor)` en una transacción con una conexión del pool y devuelve su resultado."""
+        for attempt in range(self.max_retries + 1):
+            conn = None
+            with self._slots:
+                try:
+                    conn = self._checkout()
+                    with conn.cursor() as cur:
+                        result = operation(cur)
+                    conn.commit()
+                    self._release(conn)
+                    return result
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    if conn is not None:
+                        self._discard(conn)
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self.retry_backoff * 2 ** attempt
+                    logging.warning(f"Conexión a la base de datos perdida ({e}). Reintentando en {delay:.1f} s...")
+                except Exception:
+                    if conn is not None:
+                        conn.rollback()
+                        self._release(conn)
+                    raise
+            time.sleep(delay)
 
+    def get_user(self, chat_id):
+        def query(cur):
+            cur.execute('SELECT name_user, "is_superUser", is_active FROM public.users WHERE id = %s', (chat_id,))
+            return cur.fetchone()
 
-    def update_active(self, chat_id, activo: bool):
-        cur = self.connection.cursor()
+        return self.user_cache.get_or_load(('user', chat_id), lambda: self._run(query))  # (name_user, bool, bool) o None
 
-        cur.execute(
-            'UPDATE public.users SET is_active = %s WHERE id = %s',(activo, chat_id)
-        )
-        self.connection.commit()
-        cur.close()
+    def add_user(self, chat_id, name):
+        try:
+            self._run(lambda cur: cur.execute(
+                'INSERT INTO public.users (id, name_user, "is_superUser", is_active) VALUES (%s, %s, FALSE, FALSE)',
+                (chat_id, name)
+            ))
+        finally:
+            self.user_cache.invalidate(('user', chat_id))
 
+    def update_active(self, chat_id, activo: bool):
+        try:
+            self._run(lambda cur: cur.execute(
+                'UPDATE public.users SET is_active = %s WHERE id = %s', (activo, chat_id)
+            ))
+        finally:
+            self.user_cache.invalidate(('user', chat_id))
 
     def get_all_users(self):
-        cur = self.connection.cursor()
+        def query(cur):
+            cur.execute('SELECT id, name_user, is_active FROM public.users ORDER BY id')
+            return cur.fetchall()
+
+        return self._run(query)  # lista de (id, name_user, is_active)
 
+    def get_users_page(self, after_id=None, before_id=None, search=None, limit=10):
+        """Página de usuarios por clave (keyset) sobre `id`, sin OFFSET.
 
-        cur.execute('SELECT id, name_user, is_active FROM public.users ORDER BY id')
-        rows = cur.fetchall()
-        cur.close()
+        Con `after_id` devuelve los siguientes a ese id y con `before_id` los anteriores, siempre
+        en orden ascendente. `search` filtra por nombre o id (subcadena, sin distinguir
+        mayúsculas). Devuelve (filas, hay_mas): `hay_mas` indica si quedan usuarios más allá de
+        la página en la dirección pedida.
+        """
+        conditions, params = [], []
+        if search:
+            pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            conditions.append("(name_user ILIKE %s OR CAST(id AS TEXT) LIKE %s)")
+            params += [pattern, pattern]
+        backwards = before_id is not None
+        if backwards:
+            conditions.append("id < %s")
+            params.append(before_id)
+        elif after_id is not None:
+            conditions.append("id > %s")
+            params.append(after_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "DESC" if backwards else "ASC"
 
-        return rows  # lista de (id, name_user, is_active)
+        def query(cur):
+            # Una fila de más indica si hay otra página sin necesidad de contar
+            cur.execute(f'SELECT id, name_user, is_active FROM public.users {where} ORDER BY id {order} LIMIT %s',
+                        params + [limit + 1])
+            return cur.fetchall()
 
+        rows = self._run(query)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        return rows, has_more
 
     def get_superusers(self):
-        cur = self.connection.cursor()
+        def query(cur):
+            cur.execute('SELECT id FROM public.users WHERE "is_superUser" = TRUE')
+            return tuple(r[0] for r in cur.fetchall())
+
+        return self.user_cache.get_or_load(('superusers',), lambda: self._run(query))
+
+    def _run_with_alert_schema(self, operation):
+        """Ejecuta `operation` creando antes la tabla de suscripciones si aún no se comprobó."""
+        def run(cur):
+            if not self._alert_schema_ready:
+                cur.execute(ALERT_SUBSCRIPTIONS_SCHEMA)
+            return operation(cur)
 
-        cur.execute('SELECT id FROM public.users WHERE "is_superUser" = TRUE')
-        su = [r[0] for r in cur.fetchall()]
-        cur.close()
-        return su
+        result = self._run(run)
+        self._alert_schema_ready = True  # Solo tras el commit: si falló, la tabla no llegó a crearse
+        return result
 
+    def get_alert_subscribers(self):
+        def query(cur):
+            cur.execute('SELECT chat_id FROM public.alert_subscriptions')
+            return tuple(r[0] for r in cur.fetchall())
+
+        return self.user_cache.get_or_load(('alert_subscribers',), lambda: self._run_with_alert_schema(query))
+
+    def set_alert_subscription(self, chat_id, subscribed: bool):
+        def update(cur):
+            if subscribed:
+                cur.execute('INSERT INTO public.alert_subscriptions (chat_id) VALUES (%s) ON CONFLICT DO NOTHING',
+                            (chat_id,))
+            else:
+                cur.execute('DELETE FROM public.alert_subscriptions WHERE chat_id = %s', (chat_id,))
+
+        try:
+            self._run_with_alert_schema(update)
+        finally:
+            self.user_cache.invalidate(('alert_subscribers',))
 
     def save_message(self, message):
-        if self.connection:
+        """Encola el mensaje para que el hilo escritor lo inserte en el siguiente lote."""
+        return self.writer.enqueue((datetime.now(), message))
+
+    def save_messages(self, rows):
+        """Inserta en una sola sentencia una lista de tuplas (fecha, mensaje)."""
+        self._run(lambda cur: self._insert_messages(cur, rows))
+        logging.info("%d mensajes guardados en la base de datos.", len(rows),
+                     extra={'category': 'db.batch', 'key': 'logsESP'})
+
+    # Telemetría
+    def ensure_telemetry_schema(self):
+        self._run(lambda cur: cur.execute(TELEMETRY_SCHEMA))
+        today = date.today()
+        for day in (today, today + timedelta(days=1)):
+            self.ensure_partition(day)
+
+    def ensure_partition(self, day):
+        """Crea (si no existe) la partición diaria de telemetry para `day`."""
+        if day in self._partitions:
+            return
+        self._run(lambda cur: cur.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS public.{} PARTITION OF public.telemetry "
+                    "FOR VALUES FROM (%s) TO (%s)").format(
+                sql.Identifier(f"{TELEMETRY_PARTITION_PREFIX}{day:%Y%m%d}")),
+            (day, day + timedelta(days=1))
+        ))
+        self._partitions.add(day)
+
+    def record_telemetry(self, device, variable, value, payload=None):
+        """Encola una muestra de telemetría; el hilo escritor la inserta en el siguiente lote."""
+        try:
+            value = float(value) if value is not None else None
+        except (TypeError, ValueError):
+            value = None  # El valor original queda en payload
+        return self.telemetry_writer.enqueue((datetime.now().astimezone(), device, variable, value, payload))
+
+    def save_telemetry(self, rows):
+        """Inserta una lista de tuplas (ts, device, variable, value, payload) en una sola sentencia."""
+        for day in {row[0].date() for row in rows}:
+            self.ensure_partition(day)
+        self._run(lambda cur: self._insert_telemetry(cur, rows))
+
+    @staticmethod
+    def _insert_messages(cur, rows):
+        execute_values(cur, 'INSERT INTO "logsESP" (fecha, mensaje) VALUES %s', rows, page_size=len(rows))
+
+    @staticmethod
+    def _insert_telemetry(cur, rows):
+        rows = [(ts, device, variable, value, Json(payload) if payload is not None else None)
+                for ts, device, variable, value, payload in rows]
+        execute_values(cur, 'INSERT INTO public.telemetry (ts, device, variable, value, payload) VALUES %s',
+                       rows, page_size=len(rows))
+
+    # Spool
+    def _spooling(self, writer, save):
+        """Envuelve la escritura de un lote para desviarlo al spool si Postgres no está disponible."""
+        def write(rows):
+            if self.spool is None:
+                return save(rows)
+            if self.spool.backlog():
+                # Mientras haya atraso lo nuevo va detrás, y Postgres solo lo sondea el hilo de reenvío
+                return self.spool.append(writer, rows)
             try:
-                cursor = self.connection.cursor()
-                query = 'INSERT INTO "logsESP" (fecha, mensaje) VALUES (%s, %s)'
-                cursor.execute(query, (datetime.now(), message))
-                self.connection.commit()
-                cursor.close()
-                logging.info("Mensaje guardado en la base de datos.")
+                save(rows)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logging.warning(f"Base de datos no disponible ({e}). Lote de {len(rows)} filas guardado en el spool.")
+                self.spool.append(writer, rows)
+        return write
+
+    def replay_spooled(self, batches):
+        """Aplica lotes del spool [(batch_id, writer, rows)] en una transacción, saltando los ya aplicados.
+
+        Si el bloque falla por datos inválidos se reintenta lote a lote y se descartan (con un
+        error en el log) los que no se pueden insertar, para que un lote defectuoso no bloquee
+        el spool. Cualquier otro error deja los lotes en el spool para el siguiente intento.
+        """
+        for day in {row[0].date() for _, writer, rows in batches if writer == "telemetry" for row in rows}:
+            self.ensure_partition(day)
+
+        def replay(cur):
+            if not self._spool_markers_ready:
+                cur.execute(SPOOL_MARKERS_SCHEMA)
+            new = {row[0] for row in execute_values(
+                cur, "INSERT INTO public.spool_batches (batch_id) VALUES %s ON CONFLICT DO NOTHING RETURNING batch_id",
+                [(batch_id,) for batch_id, _, _ in batches], page_size=len(batches), fetch=True
+            )}
+            messages = [row for batch_id, writer, rows in batches if batch_id in new and writer == "logsESP"
+                        for row in rows]
+            telemetry = [row for batch_id, writer, rows in batches if batch_id in new and writer == "telemetry"
+                         for row in rows]
+            if messages:
+                self._insert_messages(cur, messages)
+            if telemetry:
+                self._insert_telemetry(cur, telemetry)
+            return len(batches) - len(new)
+
+        try:
+            skipped = self._run(replay)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise  # Sigue sin conexión: el spool reintentará más tarde
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            if len(batches) == 1:
+                logging.error(f"Lote {batches[0][0]} del spool descartado: {e}")
+                return
+            for batch in batches:
+                self.replay_spooled([batch])
+            return
+        self._spool_markers_ready = True
+        if skipped:
+            logging.info(f"Spool: {skipped} lotes ya estaban aplicados.")
+
+    def stream_telemetry(self, device, variable, start, end, chunk_size=5000):
+        """Genera (ts, value, payload) del rango [start, end) leyendo por bloques con un cursor de servidor.
+
+        La conexión queda reservada mientras se consume el generador, así que conviene recorrerlo
+        entero (o cerrarlo) sin demorarse.
+        """
+        with self._slots:
+            conn = self._checkout()
+            completed = False
+            try:
+                with conn.cursor(name=f"telemetry_stream_{next(self._cursor_names)}") as cur:
+                    cur.itersize = chunk_size
+                    cur.execute(
+                        'SELECT ts, value, payload FROM public.telemetry '
+                        'WHERE device = %s AND variable = %s AND ts >= %s AND ts < %s ORDER BY ts',
+                        (device, variable, start, end)
+                    )
+                    yield from cur
+                conn.commit()
+                completed = True
+            finally:
+                if completed:
+                    self._release(conn)
+                elif conn.closed:
+                    self._discard(conn)
+                else:
+                    conn.rollback()
+                    self._release(conn)
+
+    def telemetry_partitions(self):
+        """Días que tienen partición creada, ordenados."""
+        def query(cur):
+            cur.execute(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'telemetry'"
+            )
+            return [r[0] for r in cur.fetchall()]
+
+        days = []
+        for name in self._run(query):
+            try:
+                days.append(datetime.strptime(name[len(TELEMETRY_PARTITION_PREFIX):], "%Y%m%d").date())
+            except ValueError:
+                continue
+        return sorted(days)
+
+    def compact_telemetry(self, retention_days=None):
+        """Resume por hora y elimina las particiones más antiguas que la retención.
+
+        Borrar una partición es un DROP TABLE, mucho más barato que un DELETE fila a fila.
+        """
+        retention_days = self.telemetry_retention_days if retention_days is None else retention_days
+        cutoff = date.today() - timedelta(days=retention_days)
+        for day in self.telemetry_partitions():
+            if day >= cutoff:
+                break
+            table = sql.Identifier(f"{TELEMETRY_PARTITION_PREFIX}{day:%Y%m%d}")
+
+            def rollup_and_drop(cur):
+                cur.execute(sql.SQL(
+                    "INSERT INTO public.telemetry_hourly (bucket, device, variable, samples, min, max, avg) "
+                    "SELECT date_trunc('hour', ts), device, variable, count(*), min(value), max(value), avg(value) "
+                    "FROM public.{} GROUP BY 1, 2, 3 "
+                    "ON CONFLICT (device, variable, bucket) DO UPDATE SET "
+                    "samples = telemetry_hourly.samples + EXCLUDED.samples, "
+                    "min = LEAST(telemetry_hourly.min, EXCLUDED.min), "
+                    "max = GREATEST(telemetry_hourly.max, EXCLUDED.max), "
+                    "avg = (telemetry_hourly.avg * telemetry_hourly.samples + EXCLUDED.avg * EXCLUDED.samples) "
+                    "/ (telemetry_hourly.samples + EXCLUDED.samples)"
+                ).format(table))
+                cur.execute(sql.SQL("DROP TABLE public.{}").format(table))
+
+            self._run(rollup_and_drop)
+            self._partitions.discard(day)
+            logging.info(f"Partición de telemetría {day} resumida por hora y eliminada.")
+
+    def prune_spool_markers(self, keep=timedelta(days=1)):
+        """Borra las marcas de lotes del spool aplicados hace más de `keep`; solo hacen falta unos segundos."""
+        def prune(cur):
+            cur.execute(SPOOL_MARKERS_SCHEMA)
+            cur.execute("DELETE FROM public.spool_batches WHERE replayed_at < now() - %s", (keep,))
+
+        self._run(prune)
+
+    def _maintenance_loop(self, interval):
+        while True:
+            try:
+                self.ensure_telemetry_schema()
+                self.compact_telemetry()
+                if self.spool is not None:
+                    self.prune_spool_markers()
             except Exception as e:
-                logging.error(f"Error al guardar mensaje en la base de datos: {e}")
+                logging.error(f"Error en el mantenimiento de telemetría: {e}")
+            if self._stop_maintenance.wait(interval):
+                return
+
+    def close(self):
+        """Vacía las colas de escritura (en Postgres o en el spool) y cierra las conexiones del pool."""
+        self._stop_maintenance.set()
+        self.writer.stop()
+        self.telemetry_writer.stop()
+        if self.spool is not None:
+            self.spool.close()
+        if self.pool:
+            self.pool.closeall()
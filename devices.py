@@ -0,0 +1,76 @@
+import logging
+import threading
+
+
+class Device:
+    """Dispositivo conocido: publica su estado en `topic` y recibe órdenes en `command_topic`."""
+
+    __slots__ = ('name', 'topic', 'command_topic')
+
+    def __init__(self, name, topic, command_topic=None):
+        self.name = name
+        self.topic = topic
+        self.command_topic = command_topic
+
+    def __repr__(self):
+        return f"Device({self.name!r}, topic={self.topic!r}, command_topic={self.command_topic!r})"
+
+
+class DeviceRegistry:
+    """Registro de dispositivos y tabla de despacho de mensajes.
+
+    Mapea tópico -> dispositivo y (dispositivo, tipo de mensaje) -> handler. Los handlers registrados
+    con `device=None` aplican a cualquier dispositivo que no tenga uno propio, así que el
+    despacho es siempre de dos búsquedas en diccionario, sin importar cuántos dispositivos haya.
+    """
+
+    def __init__(self):
+        self._by_topic = {}
+        self._by_name = {}
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def register_device(self, name, topic, command_topic=None):
+        """Registra (o devuelve, si ya existe) el dispositivo asociado al tópico."""
+        with self._lock:
+            device = self._by_topic.get(topic)
+            if device is not None:
+                return device
+            device = Device(name, topic, command_topic)
+            self._by_topic[topic] = device
+            self._by_name[name] = device
+        logging.info(f"Dispositivo registrado: {device}")
+        for listener in self._listeners:
+            listener(device)
+        return device
+
+    def on_register(self, listener):
+        """Llama a `listener(device)` cada vez que se registra un dispositivo nuevo."""
+        self._listeners.append(listener)
+
+    def add_handler(self, kind, handler, device=None):
+        """Asocia `handler(device, message)` al tipo de mensaje, opcionalmente solo para un dispositivo."""
+        self._handlers[(device, kind)] = handler
+
+    def by_topic(self, topic):
+        return self._by_topic.get(topic)
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def handler_for(self, device_name, kind):
+        return self._handlers.get((device_name, kind)) or self._handlers.get((None, kind))
+
+    def devices(self):
+        return list(self._by_name.values())
+
+    def command_topics(self):
+        """Tópicos de órdenes distintos, en orden de registro."""
+        return list(dict.fromkeys(d.command_topic for d in self._by_name.values() if d.command_topic))
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __len__(self):
+        return len(self._by_name)
@@ -0,0 +1,511 @@
+"""Banco de carga para MqttSubscriber, BotTelegram y DatabaseManager.
+
+Simula una flota de N dispositivos que envían keep-alives, lecturas de sensores y respuestas
+a tasas configurables, y mide:
+
+- throughput de ingesta (mensajes procesados por segundo en on_message),
+- latencia p50/p99 desde on_message hasta que la fila queda guardada (logsESP y telemetry),
+- latencia de detección de keep-alive para los dispositivos que se "apagan" a mitad de prueba.
+
+Por defecto todo corre en proceso: broker MQTT, cliente de Telegram y base de datos falsos.
+Con --broker se usa un broker real (p. ej. un mosquitto local) y con --dsn un Postgres real.
+Nunca se usa la API real de Telegram.
+
+Ejemplos:
+    python loadtest.py --devices 500 --duration 30 --sensor-rate 2
+    python loadtest.py --broker localhost:1883 --dsn "dbname=logs user=postgres host=localhost"
+    python loadtest.py --save baseline.json
+    python loadtest.py --baseline baseline.json --tolerance 0.2   # sale con código 1 si hay regresión
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from psycopg2.extensions import parse_dsn
+
+from data_base import DatabaseManager
+from log_config import setup_logging
+from main import MqttSubscriber
+from messages import dumps
+
+
+# Dobles en proceso
+class FakeMqttMessage:
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+
+
+class _PublishResult:
+    rc = mqtt.MQTT_ERR_SUCCESS
+
+    def __init__(self, mid):
+        self.mid = mid
+
+
+class FakeBroker:
+    """Broker MQTT en memoria: reparte cada publicación a los clientes suscritos."""
+
+    def __init__(self):
+        self.clients = []
+
+    def publish(self, topic, payload):
+        for client in self.clients:
+            if any(mqtt.topic_matches_sub(sub, topic) for sub in client.subscriptions):
+                client.deliver(topic, payload)
+
+
+class FakeMqttClient:
+    """Imita la parte de paho.mqtt.client.Client que usa MqttSubscriber.
+
+    Como en paho, los callbacks se ejecutan en un único hilo de red propio del cliente.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_message = None
+        self.on_publish = None
+        self.subscriptions = []
+        self._mids = itertools.count(1)
+        # Como paho: publish y la entrega de confirmaciones a on_publish van bajo el mismo lock de salida
+        self._out_message_mutex = threading.RLock()
+        self._inbox = queue.SimpleQueue()
+        self._connected = False
+        self._thread = None
+
+    def connect(self, host=None, port=None, keepalive=60):
+        self._connected = True
+        self.broker.clients.append(self)
+
+    def loop_start(self):
+        self._thread = threading.Thread(target=self._loop, name="fake-mqtt", daemon=True)
+        self._thread.start()
+
+    def loop_stop(self):
+        if self._thread:
+            self._inbox.put(None)
+            self._thread.join()
+
+    def is_connected(self):
+        return self._connected
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+        return mqtt.MQTT_ERR_SUCCESS, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._out_message_mutex:
+            self.broker.publish(topic, payload)
+            mid = next(self._mids)
+            self._inbox.put(mid)  # La confirmación llega por el hilo de red, como en paho
+            return _PublishResult(mid)
+
+    def deliver(self, topic, payload):
+        self._inbox.put(FakeMqttMessage(topic, payload))
+
+    def backlog(self):
+        return self._inbox.qsize()
+
+    def _loop(self):
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0, None)
+        while True:
+            msg = self._inbox.get()
+            if msg is None:
+                return
+            if isinstance(msg, int):
+                if self.on_publish:
+                    with self._out_message_mutex:
+                        self.on_publish(self, None, msg, 0, None)
+                continue
+            self.on_message(self, None, msg)
+
+
+class FakeTelegram:
+    """Cliente de Telegram que no sale a la red; cada envío tarda `latency` segundos."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.sent = 0
+
+    def message_handler(self, **kwargs):
+        return lambda handler: handler
+
+    def callback_query_handler(self, **kwargs):
+        return lambda handler: handler
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+        self.sent += 1
+
+    def answer_callback_query(self, *args, **kwargs):
+        pass
+
+    def infinity_polling(self, *args, **kwargs):
+        pass
+
+
+def _message_key(row):
+    return row[1].encode()
+
+
+def _telemetry_key(row):
+    return dumps(row[4])
+
+
+class FakeDatabase(DatabaseManager):
+    """DatabaseManager sin Postgres: conserva los escritores por lotes y simula la latencia de cada INSERT.
+
+    Con `flush_log` (una cola de multiprocessing) cada lote escrito informa de (payload, instante)
+    de sus filas medibles; así se mide la persistencia también en los workers de ingesta.
+    """
+
+    def __init__(self, write_latency=0.002, flush_log=None, **kwargs):
+        self.write_latency = write_latency
+        self.flush_log = flush_log
+        super().__init__(db_config={}, **kwargs)
+
+    def _log_flush(self, rows, key_of):
+        if self.flush_log is not None:
+            done = time.time()
+            keys = [key for key in map(key_of, rows) if b'"seq"' in key]
+            if keys:
+                self.flush_log.put([(key, done) for key in keys])
+
+    def connect_to_db(self):
+        return None
+
+    def _maintenance_loop(self, interval):
+        return
+
+    def get_user(self, chat_id):
+        return "bench", False, True
+
+    def get_superusers(self):
+        return ()
+
+    def get_alert_subscribers(self):
+        return ()
+
+    def save_messages(self, rows):
+        time.sleep(self.write_latency)
+        self._log_flush(rows, _message_key)
+
+    def save_telemetry(self, rows):
+        time.sleep(self.write_latency)
+        self._log_flush(rows, _telemetry_key)
+
+
+# Flota simulada
+class DeviceFleet:
+    """Genera el tráfico de N dispositivos desde un único hilo con un heap de próximos envíos."""
+
+    def __init__(self, client, devices, keep_alive_interval, sensor_rate, response_rate, prefix="bench"):
+        self.client = client
+        self.names = [f"dev{i}" for i in range(devices)]
+        self.prefix = prefix
+        self.keep_alive_interval = keep_alive_interval
+        self.sensor_rate = sensor_rate
+        self.response_rate = response_rate
+        self.sent = 0
+        self.last_keep_alive = {}
+        self.killed = set()
+        self._seq = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="fleet", daemon=True)
+
+    def topic(self, name):
+        return f"{self.prefix}/{name}"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def kill(self, count):
+        """Deja de enviar keep-alives (y todo lo demás) en `count` dispositivos."""
+        self.killed.update(random.sample(self.names, min(count, len(self.names))))
+
+    def _run(self):
+        now = time.perf_counter()
+        heap = []
+        for i, name in enumerate(self.names):
+            jitter = random.random()
+            heap.append((now + jitter * self.keep_alive_interval, i, 'keep-alive'))
+            if self.sensor_rate:
+                heap.append((now + jitter / self.sensor_rate, i, 'sensor'))
+            if self.response_rate:
+                heap.append((now + jitter / self.response_rate, i, 'response'))
+        heapq.heapify(heap)
+        periods = {
+            'keep-alive': self.keep_alive_interval,
+            'sensor': 1 / self.sensor_rate if self.sensor_rate else None,
+            'response': 1 / self.response_rate if self.response_rate else None,
+        }
+
+        while heap and not self._stop.is_set():
+            due, i, kind = heap[0]
+            wait = due - time.perf_counter()
+            if wait > 0:
+                self._stop.wait(min(wait, 0.05))
+                continue
+            heapq.heapreplace(heap, (due + periods[kind], i, kind))
+            name = self.names[i]
+            if name in self.killed:
+                continue
+            self._send(name, kind)
+
+    def _send(self, name, kind):
+        if kind == 'keep-alive':
+            payload = {'action': 'keep-alive', 'keep': True, 'device': name,
+                       'command_topic': f"{self.topic(name)}/cmd"}
+            self.last_keep_alive[name] = time.perf_counter()
+        elif kind == 'sensor':
+            self._seq += 1
+            payload = {'action': 'response_temperatura', 'dato_temperatura': round(random.uniform(18, 30), 2),
+                       'seq': self._seq}
+        else:
+            self._seq += 1
+            payload = {'action': 'response', 'dato': random.randint(0, 1000), 'seq': self._seq}
+        self.client.publish(self.topic(name), dumps(payload))
+        self.sent += 1
+
+
+# Medición
+def _percentiles(values):
+    if not values:
+        return {'p50': None, 'p99': None, 'max': None}
+    ordered = sorted(values)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {'p50': pick(50), 'p99': pick(99), 'max': ordered[-1]}
+
+
+class Probe:
+    """Envuelve los puntos de medición sin modificar las clases bajo prueba."""
+
+    def __init__(self, subscriber, db):
+        self.subscriber = subscriber
+        self.processed = 0
+        self.handler_times = []
+        self.persist_latencies = []
+        self.detections = {}
+        self._entered = {}
+        self._lock = threading.Lock()
+
+        on_message = subscriber.client.on_message
+
+        def timed_on_message(client, userdata, msg):
+            start = time.perf_counter()
+            if b'"seq"' in msg.payload:
+                self._entered[msg.payload] = time.time()  # Reloj de pared: se compara con el de los workers
+            on_message(client, userdata, msg)
+            self.handler_times.append(time.perf_counter() - start)
+            self.processed += 1
+
+        subscriber.client.on_message = timed_on_message
+
+        on_timeout = subscriber.on_keep_alive_timeout
+
+        def timed_timeout(name):
+            self.detections[name] = time.perf_counter()
+            on_timeout(name)
+
+        subscriber.on_keep_alive_timeout = timed_timeout
+
+        self._wrap_writer(db.writer, _message_key)
+        self._wrap_writer(db.telemetry_writer, _telemetry_key)
+
+    def _wrap_writer(self, writer, key_of):
+        flush = writer.flush_function
+
+        def timed_flush(rows):
+            flush(rows)
+            self.persisted([(key_of(row), time.time()) for row in rows])
+
+        writer.flush_function = timed_flush
+
+    def persisted(self, flushed):
+        """Registra filas escritas como (payload, instante); las de los workers llegan por su `flush_log`."""
+        with self._lock:
+            for key, done in flushed:
+                start = self._entered.pop(key, None)
+                if start is not None:
+                    self.persist_latencies.append(done - start)
+
+    def collect(self, flush_log):
+        """Vacía el `flush_log` de los workers (cuando ya terminaron)."""
+        while True:
+            try:
+                self.persisted(flush_log.get(timeout=0.2))
+            except queue.Empty:
+                return
+
+
+def run(args):
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        port = int(port or 1883)
+        subscriber_client = None
+        fleet_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        fleet_client.connect(host, port)
+        fleet_client.loop_start()
+    else:
+        host, port = "fake", 0
+        broker = FakeBroker()
+        subscriber_client = FakeMqttClient(broker)
+        fleet_client = FakeMqttClient(broker)
+
+    if args.dsn:
+        config = parse_dsn(args.dsn)
+        db = DatabaseManager({k: config.get(k) for k in ("dbname", "user", "password", "host", "port")},
+                             batch_size=args.batch_size, batch_delay=args.batch_delay)
+    else:
+        db = FakeDatabase(write_latency=args.write_latency, batch_size=args.batch_size,
+                          batch_delay=args.batch_delay)
+
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    # Con Postgres real los workers escriben en él y su latencia de persistencia no se mide
+    flush_log = None if args.dsn or not args.workers else multiprocessing.get_context('spawn').Queue()
+    worker_db_options = None if args.dsn else {'write_latency': args.write_latency, 'batch_size': args.batch_size,
+                                               'batch_delay': args.batch_delay, 'flush_log': flush_log}
+    subscriber = MqttSubscriber(broker=host, port=port, topics=[f"{args.prefix}/+"], db_manager=db,
+                                keep_alive_timeout=args.keep_alive_timeout, client=subscriber_client,
+                                telegram_client=telegram, workers=args.workers,
+                                worker_db_options=worker_db_options)
+    probe = Probe(subscriber, db)
+    # Con workers, on_message solo reparte; lo procesado se cuenta con lo que informan los workers
+    sharding = subscriber.sharding
+    processed = (lambda: sharding.processed) if sharding else (lambda: probe.processed)
+    if sharding:
+        sharding.start()
+    subscriber.client.connect(host, port, 5)
+    subscriber.client.loop_start()
+
+    fleet = DeviceFleet(fleet_client, args.devices, args.keep_alive_interval, args.sensor_rate,
+                        args.response_rate, prefix=args.prefix)
+    started = time.perf_counter()
+    fleet.start()
+
+    time.sleep(args.duration / 2)
+    killed_at = time.perf_counter()
+    fleet.kill(args.kill)
+    time.sleep(args.duration / 2)
+    fleet.stop()
+
+    # Dejar que se vacíen el backlog de ingesta y las colas de escritura
+    drain_deadline = time.perf_counter() + args.drain_timeout
+    while processed() < fleet.sent and time.perf_counter() < drain_deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    db.writer.stop(args.drain_timeout)
+    db.telemetry_writer.stop(args.drain_timeout)
+    subscriber.client.loop_stop()
+    if sharding:
+        sharding.stop(args.drain_timeout)
+    if flush_log is not None:
+        probe.collect(flush_log)
+
+    detection = [probe.detections[name] - (fleet.last_keep_alive[name] + args.keep_alive_timeout)
+                 for name in fleet.killed if name in probe.detections and name in fleet.last_keep_alive]
+    return {
+        'devices': args.devices,
+        'duration_s': round(elapsed, 3),
+        'messages_sent': fleet.sent,
+        'messages_processed': processed(),
+        'throughput_msg_s': round(processed() / elapsed, 1),
+        'on_message_us': {k: v and round(v * 1e6, 1) for k, v in _percentiles(probe.handler_times).items()},
+        'persisted': len(probe.persist_latencies),
+        'persist_latency_ms': {k: v and round(v * 1e3, 2) for k, v in _percentiles(probe.persist_latencies).items()},
+        'killed': len(fleet.killed),
+        'detected': len(detection),
+        'detection_overshoot_ms': {k: v and round(v * 1e3, 1) for k, v in _percentiles(detection).items()},
+        'malformed': sharding.malformed if sharding else subscriber.decoder.malformed,
+        'telegram_sent': telegram.sent,
+        'killed_after_s': round(killed_at - started, 3),
+    }
+
+
+def check_regression(report, baseline, tolerance):
+    """Compara con una ejecución anterior; devuelve la lista de métricas que empeoraron."""
+    failures = []
+    if report['throughput_msg_s'] < baseline['throughput_msg_s'] * (1 - tolerance):
+        failures.append(f"throughput {report['throughput_msg_s']} < {baseline['throughput_msg_s']}")
+    for metric in ('persist_latency_ms', 'detection_overshoot_ms', 'on_message_us'):
+        now, before = report[metric]['p99'], baseline[metric]['p99']
+        if now is None and before is not None:
+            # Una métrica que dejó de medirse no puede pasar la comparación en silencio
+            failures.append(f"{metric} sin datos en esta ejecución (la referencia tiene p99 {before})")
+        elif now is not None and before is not None and now > before * (1 + tolerance):
+            failures.append(f"{metric} p99 {now} > {before}")
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Banco de carga de la ingesta MQTT -> bot -> base de datos")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0, help="segundos de tráfico")
+    parser.add_argument("--keep-alive-interval", type=float, default=1.0)
+    parser.add_argument("--keep-alive-timeout", type=float, default=3.0)
+    parser.add_argument("--sensor-rate", type=float, default=1.0, help="lecturas por segundo y dispositivo")
+    parser.add_argument("--response-rate", type=float, default=0.5, help="'response' por segundo y dispositivo")
+    parser.add_argument("--kill", type=int, default=5, help="dispositivos que se apagan a mitad de prueba")
+    parser.add_argument("--workers", type=int, default=0, help="procesos de ingesta (0: todo en este proceso)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--batch-delay", type=float, default=1.0)
+    parser.add_argument("--write-latency", type=float, default=0.002, help="latencia simulada por lote (s)")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--drain-timeout", type=float, default=10.0)
+    parser.add_argument("--prefix", default="bench")
+    parser.add_argument("--broker", help="host:puerto de un broker real, p. ej. localhost:1883")
+    parser.add_argument("--dsn", help="cadena de conexión de un Postgres real")
+    parser.add_argument("--save", help="guarda el informe en este JSON")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior para detectar regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(level=logging.WARNING)
+    os.environ.setdefault("TELEGRAM_API_TOKEN", "0:loadtest")
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = check_regression(report, json.load(f), args.tolerance)
+        for failure in failures:
+            print(f"REGRESIÓN: {failure}", file=sys.stderr)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
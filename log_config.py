@@ -0,0 +1,130 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# Categorías del camino caliente: como mucho un registro por clave cada N segundos
+DEFAULT_RATE_LIMITS = {
+    'keep-alive': 60.0,     # clave: tópico del dispositivo
+    'mqtt.message': 10.0,   # clave: tópico
+    'mqtt.publish': 10.0,   # clave: tópico
+    'mqtt.malformed': 10.0,  # sin clave: un aviso cada 10 s como mucho
+    'device.state': 10.0,   # clave: (dispositivo, variable)
+    'db.batch': 10.0,       # clave: escritor
+}
+
+
+class SamplingFilter(logging.Filter):
+    """Muestreo y limitación de tasa por categoría.
+
+    Los registros opcionalmente llevan `extra={'category': ..., 'key': ...}`. Para cada categoría
+    se puede fijar una fracción de muestreo (`sample_rates`) y/o un intervalo mínimo entre
+    registros con la misma clave (`rate_limits`). Los registros sin categoría pasan siempre.
+    El siguiente registro que sí se emite lleva en `suppressed` cuántos se omitieron.
+    """
+
+    def __init__(self, rate_limits=None, sample_rates=None):
+        super().__init__()
+        self.rate_limits = rate_limits or {}
+        self.sample_rates = sample_rates or {}
+        self._last = {}  # (categoría, clave) -> [último instante, omitidos desde entonces]
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        if category is None:
+            return True
+        rate = self.sample_rates.get(category)
+        if rate is not None and random.random() >= rate:
+            return False
+        interval = self.rate_limits.get(category)
+        if interval is None:
+            return True
+
+        key = (category, getattr(record, 'key', None))
+        now = time.monotonic()
+        last = self._last.get(key)
+        if last is not None and now - last[0] < interval:
+            last[1] += 1
+            return False
+        record.suppressed = last[1] if last is not None else 0
+        self._last[key] = [now, 0]
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler que no formatea en el hilo que registra.
+
+    El `QueueHandler` estándar llama a `format()` antes de encolar; aquí el registro se encola
+    tal cual y el mensaje (`msg % args`) se construye en el hilo del QueueListener. Los
+    argumentos no deben mutarse después de registrar.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{text} (+{suppressed} omitidos)" if suppressed else text
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro."""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for field in ('category', 'key', 'suppressed'):
+            value = getattr(record, field, None)
+            if value is not None and value != 0:
+                entry[field] = value if isinstance(value, (int, float, str)) else str(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level=logging.INFO, structured=False, rate_limits=None, sample_rates=None,
+                  asynchronous=True, stream=None):
+    """Configura el logger raíz.
+
+    En modo asíncrono los handlers que escriben (stderr) corren en el hilo de un QueueListener
+    y el hilo que registra solo filtra y encola. Devuelve el listener (o None si es síncrono).
+    """
+    formatter = JsonFormatter() if structured else TextFormatter(TEXT_FORMAT)
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(formatter)
+
+    sampling = SamplingFilter(DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits, sample_rates)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    if not asynchronous:
+        output.addFilter(sampling)
+        root.addHandler(output)
+        return None
+
+    log_queue = queue.SimpleQueue()
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(sampling)
+    root.addHandler(handler)
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -2,131 +2,276 @@ import threading
 import paho.mqtt.client as mqtt
 import logging
 from boot_telegram import BotTelegram
-import json
 import time
 from data_base import DatabaseManager
+from devices import DeviceRegistry
+from scheduler import AsyncDeadlineScheduler, DeadlineScheduler
+from messages import SCHEMAS, KeepAlive, LedStatus, MessageDecoder, Response, SensorReading
+from metrics import REGISTRY, start_http_server
+from log_config import setup_logging
+from sharding import ShardedIngest
+from commands import CommandPublisher
+from rules import RulesEngine, load_rules
+from state import DeviceStateStore
+from async_runtime import serve
 from dotenv import load_dotenv
+import asyncio
 import os
+import signal
 
 load_dotenv()
 
+MESSAGES_RECEIVED = REGISTRY.counter('mqtt_messages_received_total', 'Mensajes MQTT recibidos', ['topic', 'action'])
+MESSAGES_MALFORMED = REGISTRY.counter('mqtt_messages_malformed_total', 'Mensajes MQTT descartados por malformados',
+                                      ['topic'])
+HANDLER_SECONDS = REGISTRY.histogram('mqtt_on_message_seconds', 'Duración de on_message por tipo de mensaje', ['kind'])
+
+# `action` viene del dispositivo: como etiqueta solo valen las del esquema y un número acotado de
+# `response_<variable>`; el resto se cuenta como 'other' para no crear series sin límite
+MAX_SENSOR_ACTION_LABELS = 32
+_sensor_action_labels = set()
+
+
+def action_label(message):
+    if message.action in SCHEMAS:
+        return message.action
+    if message.kind == SensorReading.kind:
+        if message.action in _sensor_action_labels:
+            return message.action
+        if len(_sensor_action_labels) < MAX_SENSOR_ACTION_LABELS:
+            _sensor_action_labels.add(message.action)
+            return message.action
+    return 'other'
+
 
 class MqttSubscriber:
-    def __init__(self, broker: str, port: int, topics, db_manager: DatabaseManager):
+    def __init__(self, broker: str, port: int, topics, db_manager: DatabaseManager, devices=(),
+                 keep_alive_timeout=3.0, liveness_tolerance=0.25, client=None, telegram_client=None,
+                 workers=0, worker_db_options=None, state_store=None, asynchronous=False,
+                 command_qos=1, broadcast_topic=None, rules=(), sensor_max_age=None, background_refresh=False):
         self.broker = broker
         self.port = port
         self.topics = topics if isinstance(topics, list) else [topics]
-        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        # `client` y `telegram_client` permiten inyectar dobles (ver loadtest.py)
+        self.client = client or mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.db_manager = db_manager
 
-        self.bot = BotTelegram(publish_function=self.publish_message,
-                               db_manager=self.db_manager)
-        threading.Thread(target=self.bot.start, daemon=True).start()
+        self.decoder = MessageDecoder()
+        self.registry = DeviceRegistry()
+        self.register_handlers()
+
+        # Órdenes a los dispositivos: plantillas serializadas, ventana de QoS y cola mientras no hay conexión
+        self.commands = CommandPublisher(self.client, self.registry, qos=command_qos, broadcast_topic=broadcast_topic)
+        self.client.on_publish = self.commands.on_publish
 
-        threading.Thread(target=self.monitor_keep_alive, daemon=True).start()
+        self.bot = BotTelegram(commands=self.commands,
+                               db_manager=self.db_manager,
+                               registry=self.registry,
+                               telegram_client=telegram_client,
+                               state_store=state_store,
+                               asynchronous=asynchronous,
+                               max_age=sensor_max_age,
+                               background_refresh=background_refresh)
+        # Dispositivos conocidos de antemano: (nombre, tópico de estado, tópico de órdenes)
+        for name, topic, command_topic in devices:
+            self.registry.register_device(name, topic, command_topic)
 
-    def monitor_keep_alive(self):
-        while True:
-            todos_desconectados = True  # Suponemos que todos están desconectados
+        # Cada keep-alive reprograma el plazo de su dispositivo; solo hay trabajo cuando uno vence.
+        # En modo asyncio (ver async_runtime.py) los plazos son temporizadores del bucle de eventos
+        self.keep_alive_timeout = keep_alive_timeout
+        self._all_down_alerted = False  # La alerta de "todos desconectados" se envía una vez hasta que vuelva alguno
+        scheduler = AsyncDeadlineScheduler if asynchronous else DeadlineScheduler
+        self.liveness = scheduler(tolerance=liveness_tolerance, name="keep-alive")
+        self._stopped = threading.Event()
 
-            for name, data in self.bot.led_states.items():
-                logging.info(f"{name}: {data['keep_alive']}")
-                timestamp = data.get('timestamp')
+        # Dispositivos restaurados de la copia en disco: se vuelven a registrar y los que estaban
+        # conectados reciben un plazo de keep-alive para confirmarlo
+        for state in self.bot.states.snapshot().values():
+            if state.topic is not None:
+                self.registry.register_device(state.name, state.topic, state.command_topic)
+            if state.keep_alive:
+                self.liveness.schedule(state.name, self.keep_alive_timeout,
+                                       lambda name=state.name: self.on_keep_alive_timeout(name))
 
-                if timestamp:
-                    elapsed = time.time() - timestamp
-                    if elapsed > 3 and data['keep_alive']:  # 3 segundos de inactividad
-                        logging.warning(
-                            f"❌ {name.capitalize()} desconectado. Último keep-alive hace {int(elapsed)} segundos.")
-                        self.bot.update_keep_alive(name, status=False)
+        # Reglas de alerta sobre las lecturas de sensores, evaluadas con cada lectura (ver rules.py)
+        self.rules = RulesEngine(self.bot.send_alert, rules)
+        self.bot.alerts = self.rules
 
-                # Si al menos uno está activo, entonces no están todos desconectados
-                if data['keep_alive']:
-                    todos_desconectados = False
+        # Con `workers > 0` la decodificación y la persistencia se reparten entre procesos (ver sharding.py);
+        # este proceso conserva el bot, el registro de dispositivos y el control de keep-alive
+        self.sharding = None
+        if workers > 0:
+            self.sharding = ShardedIngest(
+                workers, self.apply_shard_event, type(db_manager),
+                {'db_config': db_manager.db_config, 'spool_path': db_manager.spool and db_manager.spool.path}
+                if worker_db_options is None else worker_db_options,
+                topic_names={d.topic: d.name for d in self.registry.devices()})
+            self.client.on_message = self.sharding.submit
 
-            if todos_desconectados:
-                logging.warning("⚠️ Todos los dispositivos están desconectados.")
-                self.bot.alerta_todos_desconectados()
+        self.register_metrics()
 
-            time.sleep(10)  # Revisa cada 10 segundos
+    def register_metrics(self):
+        queue_depth = REGISTRY.gauge('queue_depth', 'Elementos pendientes en cada cola interna', ['queue'])
+        queue_depth.set_function(self.db_manager.writer.queue.qsize, queue='logsESP')
+        queue_depth.set_function(self.db_manager.telemetry_writer.queue.qsize, queue='telemetry')
+        queue_depth.set_function(self.bot.outbox.pending, queue='telegram')
+        queue_depth.set_function(lambda: len(self.bot.pending.waiting_chats()), queue='pending_requests')
+        queue_depth.set_function(self.commands.queued, queue='commands')
+        queue_depth.set_function(self.commands.inflight, queue='commands_inflight')
+        REGISTRY.gauge('devices_registered', 'Dispositivos registrados').set_function(lambda: len(self.registry))
+        REGISTRY.gauge('devices_alive', 'Dispositivos con keep-alive vigente').set_function(
+            self.bot.states.alive_count)
+
+    def on_keep_alive_timeout(self, name):
+        state = self.bot.states.get(name)
+        elapsed = time.time() - state.last_seen if state and state.last_seen else 0
+        logging.warning(f"❌ {name.capitalize()} desconectado. Último keep-alive hace {elapsed:.1f} segundos.")
+        self.bot.update_keep_alive(name, status=False)
+        self.check_all_disconnected()
+
+    def check_all_disconnected(self):
+        if not self.bot.states.alive_count() and not self._all_down_alerted:
+            self._all_down_alerted = True
+            logging.warning("⚠️ Todos los dispositivos están desconectados.")
+            self.bot.alerta_todos_desconectados()
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
         logging.info(f"Conectado con código de resultado: {reason_code}")
         for topic in self.topics:
             client.subscribe(topic)
             logging.info(f"Suscrito a: {topic}")
+        self.commands.replay()  # Órdenes que quedaron en cola mientras no había conexión
+
+    def register_handlers(self):
+        """Tabla de despacho (dispositivo, tipo de mensaje) -> handler; `device=None` aplica a todos."""
+        self.registry.add_handler(LedStatus.kind, self.handle_led_response)
+        self.registry.add_handler(SensorReading.kind, self.handle_sensor_reading)
+        self.registry.add_handler(KeepAlive.kind, self.handle_keep_alive)
+        self.registry.add_handler(Response.kind, self.handle_response)
 
     def on_message(self, client, userdata, msg):
-        message = msg.payload.decode()
-        message_json = json.loads(message)
+        start = time.perf_counter()
         topic = msg.topic
+        message = self.decoder.decode(msg.payload)
+        if message is None:
+            MESSAGES_MALFORMED.inc(topic=topic)
+            return  # Malformado: ya contado y registrado por el decoder
+        MESSAGES_RECEIVED.inc(topic=topic, action=action_label(message))
+
+        device = self.registry.by_topic(topic)
+        if device is None and message.kind == KeepAlive.kind:
+            # Un dispositivo nuevo se da de alta con su primer keep-alive
+            device = self.registry.register_device(name=message.device or topic, topic=topic,
+                                                   command_topic=message.command_topic)
+
+        handler = self.registry.handler_for(device.name if device else None, message.kind)
+        if handler is not None:
+            try:
+                handler(device, message)
+            except Exception as e:
+                # Una excepción aquí detendría el hilo de red de paho
+                logging.error(f"Error procesando mensaje de {topic}: {e}")
 
-        if message_json.get('action') == 'response_led' and topic == "NaA":
-            led_status = message_json.get('dato_led', None)
-            if led_status is not None:
-                self.bot.update_led_status(name="nairo", status=led_status)
-                logging.info(f"Estado del LED Nairo actualizado: {led_status} {type(led_status)}")
+        # Formato diferido: el texto solo se construye si el registro pasa el muestreo
+        logging.info("Mensaje recibido en %s: %s", topic, message,
+                     extra={'category': 'keep-alive' if message.kind == KeepAlive.kind else 'mqtt.message',
+                            'key': topic})
+        HANDLER_SECONDS.observe(time.perf_counter() - start, kind=message.kind)
 
-        if message_json.get('action') == 'response_led' and topic == "AaN":
-            led_status = message_json.get('dato_led', None)
-            if led_status is not None:
-                self.bot.update_led_status(name="alejandro", status=led_status)
-                logging.info(f"Estado del LED Nairo actualizado: {led_status} {type(led_status)}")
+    def handle_led_response(self, device, message):
+        if device is not None:
+            self.apply_led(device, message.value, message.corr)
+            self.db_manager.record_telemetry(device.name, 'led', message.value, message.data)
 
-        elif message_json.get('action') == 'response_temperatura' and topic == "NaA":
-            temperature = message_json.get('dato_temperatura', None)
-            if temperature is not None:
-                self.bot.update_sensor_status(variable="temperatura", value=temperature)
-                logging.info(f"Temperatura Nairo actualizada: {temperature} °C")
+    def handle_sensor_reading(self, device, message):
+        # Sin dispositivo registrado (aún sin keep-alive) no se sabe de quién es la lectura: se descarta
+        if device is not None:
+            self.apply_sensor(device, message.variable, message.value, message.corr)
+            self.db_manager.record_telemetry(device.name, message.variable, message.value, message.data)
 
-        elif message_json.get('action') == 'response_humedad' and topic == "NaA":
-            humidity = message_json.get('dato_humedad', None)
-            if humidity is not None:
-                self.bot.update_sensor_status(variable="humedad", value=humidity)
-                logging.info(f"Humedad Nairo actualizada: {humidity} %")
+    def handle_keep_alive(self, device, message):
+        self.apply_keep_alive(device, message.keep)
 
-        elif message_json.get('action') == 'keep-alive' and topic == "NaA":
-            self.bot.update_keep_alive(name="nairo", status=message_json.get('keep', None))
+    # Actualización del estado en memoria (bot y liveness), común a la ingesta local y a la particionada
+    def apply_led(self, device, value, corr_id=None):
+        self.bot.update_led_status(name=device.name, status=value, corr_id=corr_id)
+        logging.info("Estado del LED %s actualizado: %s", device.name, value,
+                     extra={'category': 'device.state', 'key': (device.name, 'led')})
 
-        elif message_json.get('action') == 'keep-alive' and topic == "AaN":
-            self.bot.update_keep_alive(name="alejandro", status=message_json.get('keep', None))
+    def apply_sensor(self, device, variable, value, corr_id=None):
+        self.bot.update_sensor_status(variable=variable, value=value, device=device.name, corr_id=corr_id)
+        self.rules.evaluate(device.name, variable, value)
+        logging.info("%s %s actualizada: %s", variable, device.name, value,
+                     extra={'category': 'device.state', 'key': (device.name, variable)})
 
-        elif message_json.get('action') == 'response':
-            print('GUARDODO ....')
-            self.db_manager.save_message(message)
+    def apply_keep_alive(self, device, keep):
+        state = self.bot.states.get(device.name)
+        was_alive = state is not None and state.keep_alive
+        self.bot.update_keep_alive(name=device.name, status=keep)
+        if keep:
+            self._all_down_alerted = False
+            self.liveness.schedule(device.name, self.keep_alive_timeout,
+                                   lambda: self.on_keep_alive_timeout(device.name))
+        else:
+            self.liveness.cancel(device.name)
+            if was_alive:
+                self.check_all_disconnected()
 
-        logging.info(f"Mensaje recibido en {topic}: {message}")
+    def apply_shard_event(self, event):
+        """Aplica un evento agregado que devuelve un worker de ingesta (ver sharding.py)."""
+        kind, topic = event[0], event[1]
+        device = self.registry.by_topic(topic)
+        if kind == 'keep-alive':
+            _, _, keep, name, command_topic = event
+            if device is None:
+                device = self.registry.register_device(name=name or topic, topic=topic, command_topic=command_topic)
+            self.apply_keep_alive(device, keep)
+        elif kind == 'led' and device is not None:
+            self.apply_led(device, event[2], event[3])
+        elif kind == 'sensor' and device is not None:
+            self.apply_sensor(device, event[2], event[3], event[4])
 
-        # self.db_manager.save_message(message)
+    def handle_response(self, device, message):
+        self.db_manager.save_message(message.text)
 
     def publish_message(self, topic, message):
-        """Publica un mensaje en el tópico especificado si hay conexión."""
-        if self.client.is_connected():
-            try:
-                result = self.client.publish(topic, json.dumps(message))
-                if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                    logging.info(f"Mensaje publicado en {topic}: {message}")
-                else:
-                    logging.warning(f"No se pudo publicar el mensaje en {topic}. Código de error: {result.rc}")
-            except Exception as e:
-                logging.error(f"Error al publicar mensaje en {topic}: {e}")
-        else:
-            logging.warning("Cliente MQTT no está conectado. No se puede publicar el mensaje.")
+        """Publica una orden en el tópico; sin conexión queda en cola hasta reconectar."""
+        try:
+            self.commands.publish(topic, message)
+        except Exception as e:
+            logging.error(f"Error al publicar mensaje en {topic}: {e}")
+
+    def stop(self):
+        """Pide a `start()` que termine (p. ej. desde un manejador de SIGTERM)."""
+        self._stopped.set()
 
     def start(self):
         try:
+            threading.Thread(target=self.bot.start, name="telegram-polling", daemon=True).start()
+            if self.sharding is not None:
+                self.sharding.start()
             self.client.connect(self.broker, self.port, 5)
             self.client.loop_start()  # Mantiene el cliente en un hilo separado
 
-            while True:
-                pass  # Mantiene la ejecución activa sin bloquear
+            self._stopped.wait()  # El hilo principal duerme hasta stop() o Ctrl+C
+        except KeyboardInterrupt:
+            logging.info("Deteniendo suscriptor MQTT...")
         except Exception as e:
             logging.error(f"Error en la conexión MQTT: {e}")
+        finally:
+            self.client.loop_stop()
+            if self.sharding is not None:
+                self.sharding.stop()
+            self.bot.outbox.stop()
+            self.bot.states.close()  # Última copia del estado para el próximo arranque
+            self.db_manager.close()  # Guarda los mensajes pendientes antes de salir
 
 
 if __name__ == "__main__":
+    setup_logging(level=os.getenv("LOG_LEVEL", "INFO"), structured=os.getenv("LOG_FORMAT") == "json")
+
     db_config = {
         "dbname": "logs",
         "user": "administrador",
@@ -135,7 +280,20 @@ if __name__ == "__main__":
         "port": "5432"
     }
 
-    db_manager = DatabaseManager(db_config=db_config)
+    asynchronous = os.getenv("RUNTIME", "threads") == "asyncio"
+    start_http_server(int(os.getenv("METRICS_PORT", "9108")))
+    db_manager = DatabaseManager(db_config=db_config, spool_path=os.getenv("SPOOL_PATH", "spool.sqlite3"))
+    state_store = DeviceStateStore(path=os.getenv("DEVICE_STATE_PATH", "device_state.sqlite3"))
     mqtt_subscriber = MqttSubscriber(broker="test.mosquitto.org", port=1883, topics=["NaA", "AaN"],
-                                     db_manager=db_manager)
-    mqtt_subscriber.start()
+                                     db_manager=db_manager,
+                                     devices=[("nairo", "NaA", "AaN"), ("alejandro", "AaN", "NaA")],
+                                     workers=int(os.getenv("INGEST_WORKERS", "0")),
+                                     state_store=state_store,
+                                     asynchronous=asynchronous,
+                                     rules=load_rules(os.environ["ALERT_RULES"]) if os.getenv("ALERT_RULES") else (),
+                                     background_refresh=os.getenv("SENSOR_BACKGROUND_REFRESH", "0") == "1")
+    if asynchronous:
+        asyncio.run(serve(mqtt_subscriber))
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: mqtt_subscriber.stop())
+        mqtt_subscriber.start()
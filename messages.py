@@ -0,0 +1,160 @@
+import json
+import logging
+from dataclasses import dataclass
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: sin él se usa el módulo json estándar
+    orjson = None
+
+
+def loads(payload: bytes):
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def dumps(message) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(message)
+    return json.dumps(message, separators=(',', ':')).encode()
+
+
+class MalformedMessage(ValueError):
+    pass
+
+
+# Mensajes tipados. `kind` es la clave con la que se despachan en el DeviceRegistry.
+@dataclass(slots=True)
+class Message:
+    kind = 'unknown'
+    action: str
+    data: dict
+    raw: bytes
+    corr: str | None = None
+
+    @property
+    def text(self):
+        return self.raw.decode(errors='replace')
+
+    def __str__(self):
+        return self.text
+
+
+@dataclass(slots=True)
+class KeepAlive(Message):
+    kind = 'keep-alive'
+    keep: bool | None = None
+    device: str | None = None
+    command_topic: str | None = None
+
+
+@dataclass(slots=True)
+class LedStatus(Message):
+    kind = 'response_led'
+    value: int = 0
+
+
+@dataclass(slots=True)
+class SensorReading(Message):
+    kind = 'sensor'
+    variable: str = ''
+    value: float = 0.0
+
+
+@dataclass(slots=True)
+class Response(Message):
+    kind = 'response'
+
+
+@dataclass(slots=True)
+class Request(Message):
+    kind = 'request'
+    request_data: str | None = None
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _optional_str(data, field):
+    """Campo de texto opcional: acaba en nombres de dispositivo, tópicos o claves, así que nada más vale."""
+    value = data.get(field)
+    if value is not None and not isinstance(value, str):
+        raise MalformedMessage(f"'{field}' inválido: {value!r}")
+    return value
+
+
+def _keep_alive(action, data, raw, corr):
+    keep = data.get('keep')
+    if keep is not None and not isinstance(keep, (bool, int)):
+        raise MalformedMessage(f"'keep' inválido: {keep!r}")
+    return KeepAlive(action, data, raw, corr, keep=keep, device=_optional_str(data, 'device'),
+                     command_topic=_optional_str(data, 'command_topic'))
+
+
+def _led(action, data, raw, corr):
+    value = data.get('dato_led')
+    if not isinstance(value, (bool, int)):
+        raise MalformedMessage(f"'dato_led' inválido: {value!r}")
+    return LedStatus(action, data, raw, corr, value=value)
+
+
+def _response(action, data, raw, corr):
+    return Response(action, data, raw, corr)
+
+
+def _request(action, data, raw, corr):
+    return Request(action, data, raw, corr, request_data=data.get('request_data'))
+
+
+# Esquema por acción. Cualquier otra acción `response_<variable>` con un campo numérico
+# `dato_<variable>` se interpreta como lectura de sensor.
+SCHEMAS = {
+    'keep-alive': _keep_alive,
+    'response_led': _led,
+    'response': _response,
+    'request': _request,
+}
+
+
+class MessageDecoder:
+    """Convierte el payload MQTT (bytes) en un mensaje tipado, una sola vez y sin lanzar excepciones.
+
+    Los payloads malformados se cuentan y se descartan devolviendo None.
+    """
+
+    def __init__(self):
+        self.decoded = 0
+        self.malformed = 0
+        self.unknown = 0
+
+    def decode(self, payload: bytes):
+        try:
+            data = loads(payload)
+            if not isinstance(data, dict):
+                raise MalformedMessage("el payload no es un objeto JSON")
+            action = data.get('action')
+            if not isinstance(action, str):
+                raise MalformedMessage("falta 'action'")
+            corr = _optional_str(data, 'corr')
+
+            parser = SCHEMAS.get(action)
+            if parser is not None:
+                message = parser(action, data, payload, corr)
+            elif action.startswith('response_'):
+                variable = action[len('response_'):]
+                value = data.get(f'dato_{variable}')
+                if not _is_number(value):
+                    raise MalformedMessage(f"'dato_{variable}' inválido: {value!r}")
+                message = SensorReading(action, data, payload, corr, variable=variable, value=value)
+            else:
+                self.unknown += 1
+                message = Message(action, data, payload, corr)
+        except (ValueError, TypeError) as e:  # Incluye errores de JSON y MalformedMessage
+            self.malformed += 1
+            logging.warning("Mensaje descartado (%s): %r", e, payload[:200], extra={'category': 'mqtt.malformed'})
+            return None
+
+        self.decoded += 1
+        return message
@@ -0,0 +1,266 @@
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        body = ','.join(f'{n}="{_escape(v)}"' for n, v in pairs)
+        return '{' + body + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return [f"{self.name}{self._format_labels(k)} {v}" for k, v in list(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Valor puntual. Con `set_function` se calcula al leer las métricas (p. ej. el tamaño de una cola)."""
+
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        self._functions[self._key(labels)] = function
+
+    def _samples(self):
+        values = dict(self._values)
+        for key, function in list(self._functions.items()):
+            try:
+                values[key] = function()
+            except Exception as e:
+                logging.debug(f"Error evaluando la métrica {self.name}: {e}")
+        return [f"{self.name}{self._format_labels(k)} {v}" for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # key -> [cuentas por bucket (+Inf al final), suma, total]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            snapshot = [(k, list(s[0]), s[1], s[2]) for k, s in self._series.items()]
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    """Conjunto de métricas con salida en el formato de texto de Prometheus.
+
+    Pedir dos veces la misma métrica devuelve la misma instancia, así cada módulo puede
+    declarar las suyas a nivel de módulo.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class SamplingProfiler:
+    """Perfilador por muestreo: cada `interval` segundos anota la pila de todos los hilos.
+
+    Se enciende y apaga en caliente; el informe usa el formato de pilas colapsadas
+    (`marco;marco;marco cuenta`), que entienden flamegraph.pl y speedscope.
+    """
+
+    def __init__(self):
+        self.interval = 0.005
+        self.samples = _Tally()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=0.005):
+        if self.running:
+            return False
+        self.interval = interval
+        self.samples = _Tally()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+        return self.report()
+
+    def report(self, limit=200):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common(limit)) + '\n'
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+PROFILER = SamplingProfiler()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+    profiler = PROFILER
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/metrics':
+            self._reply(200, self.registry.render(), 'text/plain; version=0.0.4')
+        elif url.path == '/profile/start':
+            interval = float(params.get('interval', ['0.005'])[0])
+            started = self.profiler.start(interval)
+            self._reply(200 if started else 409, "iniciado\n" if started else "ya está en marcha\n")
+        elif url.path == '/profile/stop':
+            self._reply(200, self.profiler.stop())
+        elif url.path == '/profile':
+            self._reply(200, self.profiler.report())
+        else:
+            self._reply(404, "no encontrado\n")
+
+    def _reply(self, status, body, content_type='text/plain; charset=utf-8'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics {self.address_string()} - {format % args}")
+
+
+def start_http_server(port=9108, addr='127.0.0.1'):
+    """Sirve /metrics (Prometheus) y /profile/start, /profile/stop, /profile en un hilo aparte."""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"Métricas disponibles en http://{addr}:{port}/metrics")
+    return server
@@ -0,0 +1,80 @@
+import threading
+import uuid
+
+
+class PendingRequest:
+    __slots__ = ('key', 'corr_id', 'chats')
+
+    def __init__(self, key, corr_id):
+        self.key = key
+        self.corr_id = corr_id
+        self.chats = []  # En orden de llegada, sin repetidos
+
+
+class PendingRequests:
+    """Peticiones a dispositivos en curso, indexadas por clave y por id de correlación.
+
+    Si llega una petición idéntica (misma clave) mientras otra está en vuelo, el chat se suma
+    a la existente en lugar de publicar otra vez: una sola respuesta del dispositivo atiende a
+    todos. Cada petición tiene su propio timeout, gestionado con un `DeadlineScheduler`.
+    """
+
+    def __init__(self, scheduler, timeout=5.0):
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self._by_key = {}
+        self._by_corr = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, chat_id, on_timeout, timeout=None):
+        """Registra al chat como interesado en `key`.
+
+        Devuelve (corr_id, nueva); solo cuando `nueva` es True hay que publicar la petición.
+        Si vence el plazo sin respuesta se llama a `on_timeout(key, chats)`.
+        """
+        with self._lock:
+            request = self._by_key.get(key)
+            if request is not None:
+                if chat_id is not None and chat_id not in request.chats:
+                    request.chats.append(chat_id)
+                return request.corr_id, False
+
+            request = PendingRequest(key, uuid.uuid4().hex[:12])
+            if chat_id is not None:
+                request.chats.append(chat_id)
+            self._by_key[key] = request
+            self._by_corr[request.corr_id] = request
+
+        self.scheduler.schedule(request.corr_id, self.timeout if timeout is None else timeout,
+                                lambda: self._expire(request, on_timeout))
+        return request.corr_id, True
+
+    def resolve(self, key=None, corr_id=None):
+        """Cierra la petición (por id de correlación o, si no viene, por clave) y devuelve sus chats."""
+        with self._lock:
+            request = self._by_corr.get(corr_id) if corr_id else None
+            if request is None:
+                request = self._by_key.get(key)
+            if request is None:
+                return []
+            self._remove(request)
+        self.scheduler.cancel(request.corr_id)
+        return request.chats
+
+    def waiting_chats(self):
+        with self._lock:
+            return list(dict.fromkeys(c for r in self._by_key.values() for c in r.chats))
+
+    def __contains__(self, key):
+        return key in self._by_key
+
+    def _remove(self, request):
+        self._by_key.pop(request.key, None)
+        self._by_corr.pop(request.corr_id, None)
+
+    def _expire(self, request, on_timeout):
+        with self._lock:
+            if self._by_corr.get(request.corr_id) is not request:
+                return  # Ya respondida
+            self._remove(request)
+        on_timeout(request.key, request.chats)
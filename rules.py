@@ -0,0 +1,216 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+
+RULE_ALERTS = REGISTRY.counter('rule_alerts_total', 'Transiciones de alerta del motor de reglas', ['rule', 'state'])
+RULES_ACTIVE = REGISTRY.gauge('rule_alerts_active', 'Alertas activas en este momento')
+
+
+class Rule:
+    """Regla sobre una variable de sensor: calcula una medida por muestra y la compara con límites.
+
+    Se dispara cuando la medida supera `above` (o baja de `below`) y solo se da por resuelta
+    cuando vuelve `hysteresis` unidades por dentro del límite, así un valor que oscila en el
+    borde no genera una alerta por muestra. `device=None` aplica a todos los dispositivos.
+    """
+
+    kind = 'valor'
+
+    def __init__(self, name, variable, above=None, below=None, hysteresis=0.0, device=None):
+        if above is None and below is None:
+            raise ValueError(f"La regla {name} necesita un límite (above o below)")
+        self.name = name
+        self.variable = variable
+        self.above = above
+        self.below = below
+        self.hysteresis = hysteresis
+        self.device = device
+
+    def measure(self, device, ts, value):
+        """Medida que se compara con los límites; None si aún no hay suficientes muestras."""
+        return value
+
+    def breached(self, metric, active):
+        margin = self.hysteresis if active else 0.0
+        if self.above is not None and metric > self.above - margin:
+            return True
+        return self.below is not None and metric < self.below + margin
+
+    def describe(self):
+        limits = []
+        if self.above is not None:
+            limits.append(f"> {self.above:g}")
+        if self.below is not None:
+            limits.append(f"< {self.below:g}")
+        return f"{self.kind} de {self.variable} {' o '.join(limits)}"
+
+
+class Threshold(Rule):
+    """Umbral sobre el último valor."""
+
+
+class RateOfChange(Rule):
+    """Variación entre muestras consecutivas, expresada por cada `per` segundos (por defecto, por minuto)."""
+
+    kind = 'variación'
+
+    def __init__(self, name, variable, per=60.0, **limits):
+        super().__init__(name, variable, **limits)
+        self.per = per
+        self._last = {}  # dispositivo -> (instante, valor)
+
+    def measure(self, device, ts, value):
+        previous = self._last.get(device)
+        self._last[device] = (ts, value)
+        if previous is None or ts <= previous[0]:
+            return None
+        return (value - previous[1]) / (ts - previous[0]) * self.per
+
+    def describe(self):
+        return f"{super().describe()} por {self.per:g} s"
+
+
+class _Window:
+    __slots__ = ('samples', 'total')
+
+    def __init__(self):
+        self.samples = deque()  # (instante, valor)
+        self.total = 0.0
+
+
+class WindowAverage(Rule):
+    """Media de los últimos `minutes` minutos, mantenida con una suma acumulada.
+
+    Cada muestra entra una vez en la ventana y sale una vez, así que el coste por muestra es
+    O(1) amortizado y no se recorre la ventana ni se consulta la base de datos.
+    """
+
+    kind = 'media'
+
+    def __init__(self, name, variable, minutes=5.0, min_samples=1, **limits):
+        super().__init__(name, variable, **limits)
+        self.seconds = minutes * 60
+        self.min_samples = min_samples
+        self._windows = {}  # dispositivo -> _Window
+
+    def measure(self, device, ts, value):
+        window = self._windows.get(device)
+        if window is None:
+            window = self._windows[device] = _Window()
+        window.samples.append((ts, value))
+        window.total += value
+        limit = ts - self.seconds
+        while window.samples[0][0] < limit:
+            window.total -= window.samples.popleft()[1]
+        if len(window.samples) < self.min_samples:
+            return None
+        return window.total / len(window.samples)
+
+    def describe(self):
+        return f"{super().describe()} en {self.seconds / 60:g} min"
+
+
+RULE_TYPES = {
+    'threshold': Threshold,
+    'rate': RateOfChange,
+    'window_average': WindowAverage,
+}
+
+
+def load_rules(path):
+    """Lee reglas de un JSON: lista de objetos con `type` (threshold, rate, window_average) y sus parámetros."""
+    with open(path, encoding='utf-8') as f:
+        specs = json.load(f)
+    rules = []
+    for spec in specs:
+        spec = dict(spec)
+        rule_type = RULE_TYPES.get(spec.pop('type', 'threshold'))
+        if rule_type is None:
+            raise ValueError(f"Tipo de regla desconocido en {path}: {spec}")
+        rules.append(rule_type(**spec))
+    return rules
+
+
+class Alert:
+    __slots__ = ('rule', 'device', 'metric', 'ts', 'active')
+
+    def __init__(self, rule, device, metric, ts, active):
+        self.rule = rule
+        self.device = device
+        self.metric = metric
+        self.ts = ts
+        self.active = active  # True al dispararse, False al resolverse
+
+    def __repr__(self):
+        return f"Alert({self.rule.name!r}, {self.device!r}, {self.metric!r}, active={self.active})"
+
+
+class RulesEngine:
+    """Evalúa las reglas en la ruta de ingesta, con cada lectura de sensor.
+
+    Las reglas se indexan por variable, así una lectura solo toca las reglas que le afectan.
+    Cada (regla, dispositivo) tiene un estado activo/inactivo y `notify(alert)` solo se llama
+    en las transiciones: una alerta que sigue activa no se repite.
+    """
+
+    def __init__(self, notify, rules=()):
+        self.notify = notify
+        self._rules = {}  # variable -> [reglas]
+        self._active = {}  # (regla, dispositivo) -> Alert
+        self._lock = threading.Lock()  # Ingesta local y eventos de los workers pueden llegar de hilos distintos
+        for rule in rules:
+            self.add(rule)
+        RULES_ACTIVE.set_function(lambda: len(self._active))
+
+    def add(self, rule):
+        with self._lock:
+            self._rules.setdefault(rule.variable, []).append(rule)
+
+    def rules(self):
+        return [rule for rules in self._rules.values() for rule in rules]
+
+    def active(self):
+        """Alertas activas, de la más antigua a la más reciente."""
+        return sorted(self._active.values(), key=lambda alert: alert.ts)
+
+    def evaluate(self, device, variable, value, ts=None):
+        rules = self._rules.get(variable)
+        if not rules:
+            return
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        ts = time.time() if ts is None else ts
+        transitions = []
+        with self._lock:
+            for rule in rules:
+                if rule.device is not None and rule.device != device:
+                    continue
+                metric = rule.measure(device, ts, value)
+                if metric is None:
+                    continue
+                key = (rule, device)
+                active = key in self._active
+                if rule.breached(metric, active) == active:
+                    continue
+                alert = Alert(rule, device, metric, ts, not active)
+                if alert.active:
+                    self._active[key] = alert
+                else:
+                    del self._active[key]
+                transitions.append(alert)
+        # Las notificaciones van fuera del lock; `notify` no debe bloquear (corre en la ruta de ingesta)
+        for alert in transitions:
+            RULE_ALERTS.inc(rule=alert.rule.name, state='fired' if alert.active else 'resolved')
+            logging.warning("Regla %s %s para %s: %s = %.2f", alert.rule.name,
+                            'disparada' if alert.active else 'resuelta', device, variable, alert.metric,
+                            extra={'category': 'rules', 'key': (alert.rule.name, device)})
+            try:
+                self.notify(alert)
+            except Exception as e:
+                logging.error(f"Error notificando la alerta {alert.rule.name}: {e}")
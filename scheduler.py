@@ -0,0 +1,182 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+
+def _wake_at(deadline, tolerance):
+    """Instante en que despertar por `deadline`: el final de su franja de `tolerance` segundos.
+
+    Los plazos de una misma franja comparten despertar, así se agrupan sin atender ninguno antes
+    de tiempo y con un retraso menor que `tolerance`.
+    """
+    if tolerance <= 0:
+        return deadline
+    return math.ceil(deadline / tolerance) * tolerance
+
+
+class DeadlineScheduler:
+    """Planificador de plazos por clave sobre un min-heap, atendido por un único hilo.
+
+    Cada clave tiene como mucho un plazo vigente. Reprogramar una clave que ya está en el
+    heap solo actualiza un diccionario; la entrada antigua se reinserta con el plazo nuevo
+    cuando llega su turno. Así, refrescar un plazo (p. ej. con cada keep-alive) cuesta O(1)
+    y el hilo solo despierta cuando algún plazo vence de verdad.
+
+    Ningún plazo se atiende antes de tiempo. Para agrupar, el hilo despierta en múltiplos de
+    `tolerance`: los plazos de una misma franja se atienden juntos al final de ella, con un
+    retraso menor que `tolerance`.
+    """
+
+    def __init__(self, tolerance=0.1, name="deadline-scheduler"):
+        self.tolerance = tolerance  # Retraso máximo admitido para atender juntos plazos cercanos
+        self._heap = []  # (plazo, seq, key)
+        self._entries = {}  # key -> [plazo, callback]
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def schedule(self, key, delay, callback):
+        """Programa `callback()` para dentro de `delay` segundos, reemplazando el plazo anterior de `key`."""
+        deadline = time.monotonic() + delay
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= deadline:
+                # Ya hay una entrada en el heap que vence antes: basta con actualizar el plazo
+                entry[0], entry[1] = deadline, callback
+                return
+            self._entries[key] = [deadline, callback]
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+            if self._heap[0][2] == key:
+                self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._entries.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            due = []
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+
+                now = time.monotonic()
+                if self._heap[0][0] > now:
+                    self._cond.wait(_wake_at(self._heap[0][0], self.tolerance) - now)
+                    continue
+
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, _, key = heapq.heappop(self._heap)
+                    entry = self._entries.get(key)
+                    if entry is None:
+                        continue  # Cancelado
+                    if entry[0] > deadline:
+                        # Se refrescó mientras estaba en el heap: se reinserta con el plazo actual
+                        heapq.heappush(self._heap, (entry[0], next(self._seq), key))
+                        continue
+                    del self._entries[key]
+                    due.append(entry[1])
+
+            for callback in due:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Error en tarea programada: {e}")
+
+
+class AsyncDeadlineScheduler:
+    """Variante de DeadlineScheduler para el modo asyncio: los plazos son temporizadores del bucle.
+
+    Misma interfaz y mismo refresco en O(1): reprogramar una clave a un plazo posterior solo
+    actualiza su entrada y, cuando vence el temporizador antiguo, se rearma con el plazo vigente.
+    Los plazos programados antes de `start()` se arman al arrancar. Se puede llamar desde otros
+    hilos; la operación se traslada al hilo del bucle.
+    """
+
+    def __init__(self, tolerance=0.1, name="deadline-scheduler"):
+        self.tolerance = tolerance
+        self.name = name
+        self._entries = {}  # key -> [plazo, callback, temporizador del bucle]
+        self._loop = None
+        self._loop_thread = None
+
+    def start(self):
+        """Se llama desde el bucle de eventos que atenderá los plazos."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        for key, entry in self._entries.items():
+            entry[2] = self._arm(key, entry[0])
+
+    def _call(self, function, *args):
+        if self._loop is not None and threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(function, *args)
+        else:
+            function(*args)
+
+    def schedule(self, key, delay, callback):
+        """Programa `callback()` para dentro de `delay` segundos, reemplazando el plazo anterior de `key`."""
+        self._call(self._set, key, time.monotonic() + delay, callback)
+
+    def cancel(self, key):
+        self._call(self._cancel, key)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stop(self):
+        for entry in self._entries.values():
+            if entry[2] is not None:
+                entry[2].cancel()
+        self._entries.clear()
+
+    def _arm(self, key, deadline):
+        if self._loop is None:
+            return None
+        delay = _wake_at(deadline, self.tolerance) - time.monotonic()
+        return self._loop.call_later(max(0.0, delay), self._fire, key)
+
+    def _set(self, key, deadline, callback):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[0] <= deadline:
+            # El temporizador vigente vence antes: al dispararse se rearma con este plazo
+            entry[0], entry[1] = deadline, callback
+            return
+        if entry is not None and entry[2] is not None:
+            entry[2].cancel()
+        self._entries[key] = [deadline, callback, self._arm(key, deadline)]
+
+    def _cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            entry[2].cancel()
+
+    def _fire(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if entry[0] > time.monotonic():
+            # Refrescado mientras esperaba (o el bucle adelantó el temporizador): nunca antes del plazo
+            entry[2] = self._arm(key, entry[0])
+            return
+        del self._entries[key]
+        try:
+            entry[1]()
+        except Exception as e:
+            logging.error(f"Error en tarea programada: {e}")
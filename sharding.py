@@ -0,0 +1,237 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from log_config import setup_logging
+from messages import KeepAlive, LedStatus, MessageDecoder, Response, SensorReading
+from metrics import REGISTRY
+
+SHARD_MESSAGES = REGISTRY.counter('ingest_worker_messages_total', 'Mensajes decodificados por cada worker de ingesta',
+                                  ['worker'])
+SHARD_MALFORMED = REGISTRY.counter('ingest_worker_malformed_total', 'Mensajes malformados por cada worker de ingesta',
+                                   ['worker'])
+SHARD_DROPPED = REGISTRY.counter('ingest_worker_dropped_total', 'Mensajes descartados porque la cola del worker estaba llena',
+                                 ['worker'])
+SHARD_RESTARTS = REGISTRY.counter('ingest_worker_restarts_total', 'Workers de ingesta reiniciados tras terminar solos',
+                                  ['worker'])
+SHARD_EVENTS = REGISTRY.counter('ingest_worker_events_total', 'Eventos de estado devueltos al proceso principal',
+                                ['worker'])
+
+
+def shard_for(topic, workers):
+    """Worker dueño del tópico: estable entre ejecuciones (crc32, no `hash()`, que cambia por proceso)."""
+    return zlib.crc32(topic.encode()) % workers
+
+
+def _handle(topic, payload, decoder, names, db_manager, events):
+    """Decodifica y persiste un mensaje y deja en `events` su evento agregado (ver `_worker_main`)."""
+    message = decoder.decode(payload)
+    if message is None:
+        return
+    name = names.get(topic)
+    kind = message.kind
+    if kind == KeepAlive.kind:
+        if name is None:
+            names[topic] = message.device or topic
+        key = (topic, kind)
+        event = ('keep-alive', topic, message.keep, message.device, message.command_topic)
+    elif kind == LedStatus.kind:
+        if name is not None:
+            db_manager.record_telemetry(name, 'led', message.value, message.data)
+        key = (topic, 'led')
+        event = ('led', topic, message.value, message.corr)
+    elif kind == SensorReading.kind:
+        if name is not None:
+            db_manager.record_telemetry(name, message.variable, message.value, message.data)
+        key = (topic, message.variable)
+        event = ('sensor', topic, message.variable, message.value, message.corr)
+    else:
+        if kind == Response.kind:
+            db_manager.save_message(message.text)
+        return
+    if message.corr is not None:
+        key += (message.corr,)
+    events.pop(key, None)  # Reinsertar al final conserva el orden relativo de los eventos
+    events[key] = event
+
+
+def _worker_main(index, generation, inbox, results, db_factory, db_options, topic_names, log_level):
+    """Bucle de un worker: decodifica, persiste y devuelve el estado agregado de cada lote.
+
+    Cada lote produce como mucho un evento por (tópico, variable) con el último valor, salvo los
+    que llevan `corr`, que se conservan todos porque responden a una petición concreta.
+    """
+    setup_logging(level=log_level)
+    if db_options.get('spool_path'):
+        db_options = dict(db_options, spool_path=f"{db_options['spool_path']}.{index}")  # Un spool por worker
+    db_manager = db_factory(maintenance_interval=None, **db_options)
+    decoder = MessageDecoder()
+    names = dict(topic_names)  # tópico -> nombre; aprende los dispositivos nuevos por su keep-alive
+    failed = 0  # Mensajes decodificados cuyo procesamiento falló; cuentan como malformados
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            events = {}
+            for topic, payload in batch:
+                try:
+                    _handle(topic, payload, decoder, names, db_manager, events)
+                except Exception as e:
+                    # Un mensaje que rompe el procesamiento no puede tumbar el worker: se cuenta y se sigue
+                    failed += 1
+                    logging.error("Error procesando mensaje de %s en el worker %s: %s", topic, index, e,
+                                  extra={'category': 'mqtt.malformed'})
+            results.put((index, generation, list(events.values()), decoder.decoded - failed,
+                         decoder.malformed + failed))
+    except KeyboardInterrupt:
+        pass  # El proceso principal decide cuándo parar
+    finally:
+        db_manager.close()
+
+
+class ShardedIngest:
+    """Reparte la ingesta MQTT entre N procesos por hash del tópico.
+
+    Cada tópico (y por tanto cada dispositivo) pertenece siempre al mismo worker, así que sus
+    mensajes se procesan en orden. El hilo de red de paho solo agrupa (tópico, payload) por worker
+    y los envía en lotes; decodificar y persistir ocurre en los workers, cada uno con su propio
+    DatabaseManager. El estado resultante vuelve agregado y se aplica con `apply_event` en un
+    hilo del proceso principal, donde viven el bot y el control de keep-alive.
+    """
+
+    def __init__(self, workers, apply_event, db_factory, db_options, topic_names=None, batch_size=256,
+                 flush_interval=0.005, queue_size=256, put_timeout=0.5, health_interval=1.0):
+        self.workers = workers
+        self.apply_event = apply_event
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.health_interval = health_interval
+        self.queue_size = queue_size
+
+        # spawn: los workers no heredan hilos ni conexiones abiertas del proceso principal
+        self._context = multiprocessing.get_context('spawn')
+        self.inboxes = [self._context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.results = self._context.Queue()
+        self._buffers = [[] for _ in range(workers)]
+        self._locks = [threading.Lock() for _ in range(workers)]
+        # (worker, generación) -> (decodificados, malformados) según el último informe de ese proceso;
+        # un worker reiniciado empieza otra generación y lo contado por el anterior se conserva
+        self._counts = {}
+        self._worker_args = (db_factory, db_options, dict(topic_names or {}), logging.getLogger().level)
+        self._generations = [0] * workers
+        self._processes = [self._new_process(i) for i in range(workers)]
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _new_process(self, index):
+        return self._context.Process(target=_worker_main, name=f"ingest-{index}", daemon=True,
+                                     args=(index, self._generations[index], self.inboxes[index], self.results,
+                                           *self._worker_args))
+
+    @property
+    def processed(self):
+        """Mensajes que ya pasaron por algún worker (decodificados o descartados)."""
+        return sum(decoded + malformed for decoded, malformed in list(self._counts.values()))
+
+    @property
+    def malformed(self):
+        return sum(malformed for _, malformed in list(self._counts.values()))
+
+    def _check_workers(self):
+        """Reinicia los workers que terminaron sin que se les pidiera; su cola sigue intacta."""
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or self._stop.is_set():
+                continue
+            logging.error(f"El worker de ingesta {process.name} terminó inesperadamente "
+                          f"(código {process.exitcode}); se reinicia.")
+            SHARD_RESTARTS.inc(worker=index)
+            # Un proceso que muere dentro de get() puede dejar tomado el lock interno de su cola:
+            # el nuevo worker recibe una cola nueva y los lotes que quedaban en la anterior se pierden
+            with self._locks[index]:
+                self.inboxes[index] = self._context.Queue(maxsize=self.queue_size)
+            self._generations[index] += 1
+            self._processes[index] = self._new_process(index)
+            self._processes[index].start()
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        for target, name in ((self._flush_loop, "ingest-flush"), (self._results_loop, "ingest-results")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Ingesta repartida entre {self.workers} procesos.")
+
+    def submit(self, client, userdata, msg):
+        """Sustituye a `on_message` en el cliente MQTT: solo encola el mensaje para su worker."""
+        index = shard_for(msg.topic, self.workers)
+        with self._locks[index]:
+            buffer = self._buffers[index]
+            buffer.append((msg.topic, msg.payload))
+            if len(buffer) >= self.batch_size:
+                self._send(index)
+
+    def _send(self, index):
+        # Se llama con el lock del worker tomado, así los lotes de un mismo worker no se adelantan
+        batch, self._buffers[index] = self._buffers[index], []
+        try:
+            self.inboxes[index].put(batch, timeout=self.put_timeout)
+        except queue.Full:
+            SHARD_DROPPED.inc(len(batch), worker=index)
+            logging.warning("Cola del worker de ingesta %s llena; %s mensajes descartados.", index, len(batch),
+                            extra={'category': 'db.batch', 'key': f"ingest-{index}"})
+
+    def _flush_loop(self):
+        next_check = time.monotonic() + self.health_interval
+        while not self._stop.wait(self.flush_interval):
+            self._flush_all()
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + self.health_interval
+                self._check_workers()
+
+    def _flush_all(self):
+        for index in range(self.workers):
+            with self._locks[index]:
+                if self._buffers[index]:
+                    self._send(index)
+
+    def _results_loop(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            index, generation, events, decoded, malformed = item
+            previous_decoded, previous_malformed = self._counts.get((index, generation), (0, 0))
+            self._counts[index, generation] = (decoded, malformed)
+            SHARD_MESSAGES.inc(decoded - previous_decoded, worker=index)
+            SHARD_MALFORMED.inc(malformed - previous_malformed, worker=index)
+            SHARD_EVENTS.inc(len(events), worker=index)
+            for event in events:
+                try:
+                    self.apply_event(event)
+                except Exception as e:
+                    logging.error(f"Error aplicando el evento {event[0]} de {event[1]}: {e}")
+
+    def stop(self, timeout=10.0):
+        """Envía lo pendiente, espera a que los workers vacíen sus colas y escrituras, y los detiene."""
+        self._stop.set()
+        self._flush_all()
+        for inbox in self.inboxes:
+            try:
+                inbox.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"El worker {process.name} no terminó a tiempo; se fuerza su salida.")
+                process.terminate()
+        self.results.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
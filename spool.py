@@ -0,0 +1,158 @@
+import logging
+import pickle
+import sqlite3
+import threading
+import uuid
+
+from metrics import REGISTRY
+
+SPOOL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS batches (
+    id     INTEGER PRIMARY KEY AUTOINCREMENT,
+    writer TEXT    NOT NULL,
+    nrows  INTEGER NOT NULL,
+    data   BLOB    NOT NULL
+);
+"""
+
+SPOOL_BATCHES = REGISTRY.gauge('spool_pending_batches', 'Lotes guardados en el spool local pendientes de reenviar')
+SPOOL_BYTES = REGISTRY.gauge('spool_bytes', 'Bytes de datos guardados en el spool local')
+SPOOL_SPOOLED = REGISTRY.counter('spool_spooled_rows_total', 'Filas desviadas al spool local', ['writer'])
+SPOOL_REPLAYED = REGISTRY.counter('spool_replayed_rows_total', 'Filas reenviadas desde el spool local', ['writer'])
+SPOOL_DROPPED = REGISTRY.counter('spool_dropped_rows_total', 'Filas descartadas por superar el tamaño máximo del spool',
+                                 ['writer'])
+
+
+class Spool:
+    """Almacén local (SQLite en modo WAL) de lotes que no se pudieron escribir en Postgres.
+
+    Cada lote se guarda tal cual (serializado con pickle: el fichero es local y solo lo lee este
+    proceso) con un id creciente. Un hilo reenvía los más antiguos en bloques de hasta
+    `replay_rows` filas llamando a `replay_function([(batch_id, writer, rows), ...])`; si la
+    llamada termina sin excepción los lotes se borran, y si falla se reintenta con backoff.
+    `batch_id` es único entre ficheros (uuid del spool + id), así que el destino puede usarlo
+    como marca para no aplicar dos veces un lote si el proceso cae entre su commit y el borrado.
+
+    El tamaño está acotado por `max_bytes`: al superarlo se descartan los lotes más antiguos.
+    """
+
+    def __init__(self, path, replay_function, max_bytes=512 * 2 ** 20, replay_rows=20000, retry_interval=1.0,
+                 max_retry_interval=60.0):
+        self.path = path
+        self.replay_function = replay_function
+        self.max_bytes = max_bytes
+        self.replay_rows = replay_rows
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA journal_size_limit=%d" % (16 * 2 ** 20))  # El WAL también cuenta como disco
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")  # Solo aplica a ficheros nuevos
+        self._conn.executescript(SPOOL_SCHEMA)
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'uid'").fetchone()
+        if row is None:
+            row = (uuid.uuid4().hex,)
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('uid', ?)", row)
+        self.uid = row[0]
+        self.pending, self.bytes = self._conn.execute(
+            "SELECT count(*), coalesce(sum(length(data)), 0) FROM batches").fetchone()
+        if self.pending:
+            logging.warning(f"Spool {path}: {self.pending} lotes pendientes de la ejecución anterior.")
+
+        SPOOL_BATCHES.set_function(lambda: self.pending)
+        SPOOL_BYTES.set_function(lambda: self.bytes)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._replay_loop, name="spool-replay", daemon=True)
+        self._thread.start()
+
+    def backlog(self):
+        """True si hay lotes esperando; lo nuevo debe ir detrás para conservar el orden."""
+        return self.pending > 0
+
+    def append(self, writer, rows):
+        data = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute("INSERT INTO batches (writer, nrows, data) VALUES (?, ?, ?)",
+                               (writer, len(rows), data))
+            self.pending += 1
+            self.bytes += len(data)
+            if self.bytes > self.max_bytes:
+                self._trim()
+        SPOOL_SPOOLED.inc(len(rows), writer=writer)
+        self._wakeup.set()
+
+    def _trim(self):
+        """Descarta los lotes más antiguos hasta volver por debajo de `max_bytes` (con el lock tomado)."""
+        excess = self.bytes - self.max_bytes
+        dropped = []
+        for batch_id, writer, nrows, size in self._conn.execute(
+                "SELECT id, writer, nrows, length(data) FROM batches ORDER BY id"):
+            if excess <= 0:
+                break
+            dropped.append((batch_id, writer, nrows, size))
+            excess -= size
+        self._conn.execute("DELETE FROM batches WHERE id <= ?", (dropped[-1][0],))
+        self._conn.execute("PRAGMA incremental_vacuum")
+        for _, writer, nrows, size in dropped:
+            self.bytes -= size
+            SPOOL_DROPPED.inc(nrows, writer=writer)
+        self.pending -= len(dropped)
+        logging.error("Spool %s lleno: se descartaron %d filas antiguas.", self.path, sum(d[2] for d in dropped),
+                      extra={'category': 'db.batch', 'key': 'spool.full'})
+
+    def _oldest(self):
+        batches, total = [], 0
+        with self._lock:
+            for batch_id, writer, nrows, data in self._conn.execute(
+                    "SELECT id, writer, nrows, data FROM batches ORDER BY id"):
+                if batches and total + nrows > self.replay_rows:
+                    break
+                batches.append((batch_id, writer, pickle.loads(data), len(data)))
+                total += nrows
+        return batches
+
+    def _replay_loop(self):
+        delay = self.retry_interval
+        while not self._stop.is_set():
+            if not self.pending:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            batches = self._oldest()
+            try:
+                self.replay_function([(f"{self.uid}:{batch_id}", writer, rows)
+                                      for batch_id, writer, rows, _ in batches])
+            except Exception as e:
+                logging.warning(f"No se pudo reenviar el spool ({e}). Reintento en {delay:.1f} s",
+                                extra={'category': 'db.batch', 'key': 'spool'})
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+                continue
+            delay = self.retry_interval
+            # Los lotes leídos son todos los ids hasta el último; alguno pudo descartarse por tamaño mientras
+            first, last = batches[0][0], batches[-1][0]
+            with self._lock:
+                existing = {row[0] for row in self._conn.execute(
+                    "SELECT id FROM batches WHERE id BETWEEN ? AND ?", (first, last))}
+                self._conn.execute("DELETE FROM batches WHERE id BETWEEN ? AND ?", (first, last))
+                self._conn.execute("PRAGMA incremental_vacuum")
+                for batch_id, writer, rows, size in batches:
+                    if batch_id in existing:
+                        self.pending -= 1
+                        self.bytes -= size
+                        SPOOL_REPLAYED.inc(len(rows), writer=writer)
+            logging.info("Spool: %d lotes reenviados, %d pendientes.", len(batches), self.pending,
+                         extra={'category': 'db.batch', 'key': 'spool'})
+
+    def close(self):
+        """Detiene el reenvío; lo que quede pendiente se reenvía en el próximo arranque."""
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS device_state (
+    name          TEXT PRIMARY KEY,
+    topic         TEXT,
+    command_topic TEXT,
+    led           INTEGER,
+    keep_alive    INTEGER,
+    last_seen     REAL,
+    sensors       TEXT
+)
+"""
+
+
+class DeviceState:
+    """Estado de un dispositivo. Inmutable por convención: cada escritura crea un registro nuevo.
+
+    `sensors` mapea variable -> (valor, instante) y tampoco se modifica en sitio. El LED también
+    tiene su entrada ('led') para saber cuándo se leyó por última vez.
+    """
+
+    __slots__ = ('name', 'topic', 'command_topic', 'led', 'keep_alive', 'last_seen', 'sensors')
+
+    def __init__(self, name, topic=None, command_topic=None, led=None, keep_alive=None, last_seen=None,
+                 sensors=None):
+        self.name = name
+        self.topic = topic
+        self.command_topic = command_topic
+        self.led = led
+        self.keep_alive = keep_alive
+        self.last_seen = last_seen
+        self.sensors = sensors or {}
+
+    def replace(self, **changes):
+        values = {field: getattr(self, field) for field in self.__slots__}
+        values.update(changes)
+        return DeviceState(**values)
+
+    @property
+    def led_text(self):
+        if self.led is None:
+            return 'Desconocido'
+        return 'Encendido' if self.led else 'Apagado'
+
+    def sensor(self, variable):
+        """(valor, instante) de la última lectura de `variable`, o (None, None)."""
+        return self.sensors.get(variable, (None, None))
+
+    def __repr__(self):
+        return (f"DeviceState({self.name!r}, led={self.led!r}, keep_alive={self.keep_alive!r}, "
+                f"last_seen={self.last_seen!r}, sensors={self.sensors!r})")
+
+
+class DeviceStateStore:
+    """Estado de los dispositivos compartido entre hilos, con copia en disco para reinicios en caliente.
+
+    Las lecturas no toman locks: `get` devuelve un registro inmutable y `snapshot` copia el
+    diccionario de registros, una operación atómica bajo el GIL, así que ven siempre un estado
+    coherente de cada dispositivo. Las escrituras de un mismo dispositivo se serializan con un
+    lock por franja (no hay un lock global) y sustituyen su registro.
+
+    Con `path` el estado se carga de un fichero SQLite al crear el almacén y cada
+    `snapshot_interval` segundos se vuelcan los dispositivos que cambiaron.
+    """
+
+    def __init__(self, path=None, snapshot_interval=5.0, stripes=16):
+        self.path = path
+        self._records = {}
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self.version = 0  # Aumenta con cada cambio; sirve para invalidar vistas derivadas
+        self._stop = threading.Event()
+        self._thread = None
+        if path:
+            self.load()
+            self._thread = threading.Thread(target=self._snapshot_loop, args=(snapshot_interval,),
+                                            name="device-state-snapshot", daemon=True)
+            self._thread.start()
+
+    def _lock_for(self, name):
+        return self._stripes[hash(name) % len(self._stripes)]
+
+    def _update(self, name, **changes):
+        with self._lock_for(name):
+            record = self._records.get(name)
+            if record is None:
+                return None
+            record = self._records[name] = record.replace(**changes)
+        self._mark_dirty(name)
+        return record
+
+    def _mark_dirty(self, name):
+        with self._dirty_lock:
+            self._dirty.add(name)
+            self.version += 1
+
+    # Lecturas (sin locks)
+    def get(self, name):
+        return self._records.get(name)
+
+    def snapshot(self):
+        """Copia nombre -> DeviceState de todos los dispositivos."""
+        return dict(self._records)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def alive_count(self):
+        return sum(1 for record in self.snapshot().values() if record.keep_alive)
+
+    # Escrituras
+    def add(self, name, topic=None, command_topic=None):
+        """Da de alta el dispositivo si no existe; si venía de la copia en disco actualiza sus tópicos."""
+        with self._lock_for(name):
+            record = self._records.get(name)
+            if record is not None and (record.topic, record.command_topic) == (topic, command_topic):
+                return record
+            if record is None:
+                record = DeviceState(name, topic, command_topic)
+            else:
+                record = record.replace(topic=topic, command_topic=command_topic)
+            self._records[name] = record
+        self._mark_dirty(name)
+        return record
+
+    def set_keep_alive(self, name, alive, ts=None):
+        if alive:
+            return self._update(name, keep_alive=alive, last_seen=ts or time.time())
+        return self._update(name, keep_alive=alive)
+
+    def set_led(self, name, value, ts=None):
+        return self.set_sensor(name, 'led', value, ts, led=value)
+
+    def set_sensor(self, name, variable, value, ts=None, **changes):
+        with self._lock_for(name):
+            record = self._records.get(name)
+            if record is None:
+                return None
+            sensors = dict(record.sensors)
+            sensors[variable] = (value, ts or time.time())
+            record = self._records[name] = record.replace(sensors=sensors, **changes)
+        self._mark_dirty(name)
+        return record
+
+    def expire_reading(self, name, variable):
+        """Marca la última lectura como desconocida en el tiempo (conserva el valor), p. ej. tras una orden."""
+        with self._lock_for(name):
+            record = self._records.get(name)
+            if record is None or variable not in record.sensors:
+                return None
+            sensors = dict(record.sensors)
+            sensors[variable] = (sensors[variable][0], None)
+            record = self._records[name] = record.replace(sensors=sensors)
+        self._mark_dirty(name)
+        return record
+
+    # Persistencia
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(STATE_SCHEMA)
+        return connection
+
+    def load(self):
+        """Carga la última copia en disco. Devuelve el número de dispositivos restaurados."""
+        if not os.path.exists(self.path):
+            return 0
+        start = time.perf_counter()
+        try:
+            connection = self._connect()
+            try:
+                rows = connection.execute(
+                    "SELECT name, topic, command_topic, led, keep_alive, last_seen, sensors FROM device_state"
+                ).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            logging.error(f"No se pudo cargar el estado de los dispositivos de {self.path}: {e}")
+            return 0
+
+        for name, topic, command_topic, led, keep_alive, last_seen, sensors in rows:
+            sensors = {variable: tuple(reading) for variable, reading in json.loads(sensors or '{}').items()}
+            self._records[name] = DeviceState(name, topic, command_topic, led,
+                                              None if keep_alive is None else bool(keep_alive), last_seen, sensors)
+        self.version += 1
+        logging.info(f"Estado de {len(rows)} dispositivos restaurado en {(time.perf_counter() - start) * 1e3:.1f} ms.")
+        return len(rows)
+
+    def save(self):
+        """Vuelca a disco los dispositivos que cambiaron desde la última copia."""
+        with self._dirty_lock:
+            names, self._dirty = self._dirty, set()
+        if not names or not self.path:
+            return 0
+        rows = []
+        for name in names:
+            record = self._records.get(name)
+            if record is not None:
+                rows.append((record.name, record.topic, record.command_topic, record.led,
+                             None if record.keep_alive is None else int(bool(record.keep_alive)),
+                             record.last_seen, json.dumps(record.sensors)))
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO device_state "
+                        "(name, topic, command_topic, led, keep_alive, last_seen, sensors) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            logging.error(f"No se pudo guardar el estado de los dispositivos en {self.path}: {e}")
+            with self._dirty_lock:
+                self._dirty |= names  # Se reintenta en la siguiente copia
+            return 0
+        return len(rows)
+
+    def _snapshot_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.save()
+
+    def close(self):
+        """Detiene las copias periódicas y hace una última."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.save()
@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from telebot.apihelper import ApiTelegramException
+
+from metrics import REGISTRY
+
+MAX_MESSAGE_LENGTH = 4096
+
+TELEGRAM_SEND_SECONDS = REGISTRY.histogram('telegram_send_seconds', 'Duración de cada llamada a sendMessage')
+TELEGRAM_SEND_ERRORS = REGISTRY.counter('telegram_send_errors_total', 'Errores al enviar a Telegram', ['code'])
+TELEGRAM_MERGED = REGISTRY.counter('telegram_merged_messages_total', 'Mensajes unidos a otro antes de enviarse')
+
+
+class TokenBucket:
+    """Limitador de tasa: `rate` tokens por segundo con ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Consume un token y devuelve cuántos segundos hay que esperar antes de usarlo."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class _Outgoing:
+    __slots__ = ('text', 'kwargs', 'attempts')
+
+    def __init__(self, text, kwargs):
+        self.text = text
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class TelegramOutbox:
+    """Cola de salida de mensajes de Telegram atendida por un pool de hilos.
+
+    `send_message` solo encola, así el hilo que lo llama (p. ej. el callback de paho) nunca
+    espera a la API de Telegram. Cada chat tiene su propia cola y la atiende un solo hilo a la
+    vez, de modo que el orden por chat se conserva. Se respetan los límites de Telegram con un
+    token bucket global y un intervalo mínimo por chat; ante un 429 se espera `retry_after`.
+    Los mensajes sin teclado que se acumulan para un mismo chat se envían juntos.
+    """
+
+    def __init__(self, bot, workers=4, global_rate=30.0, per_chat_interval=1.0, max_attempts=5,
+                 retry_backoff=1.0):
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+
+        self._chats = {}  # chat_id -> deque de _Outgoing
+        self._next_send = {}  # chat_id -> instante (monotonic) a partir del cual se puede enviar
+        self._ready = queue.Queue()  # chats con mensajes pendientes y sin hilo asignado
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self.sent = 0
+        self.failed = 0
+
+        self._start_workers(workers)
+
+    def _start_workers(self, workers):
+        self._workers = [threading.Thread(target=self._run, name=f"telegram-outbox-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _wake(self, chat_id):
+        """Entrega a un worker un chat con mensajes pendientes."""
+        self._ready.put(chat_id)
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._lock:
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                messages = self._chats[chat_id] = deque()
+                self._wake(chat_id)
+            messages.append(_Outgoing(text, kwargs))
+            self._pending += 1
+
+    def pending(self):
+        return self._pending
+
+    def flush(self, timeout=None):
+        """Espera a que se vacíe la cola. Devuelve False si vence el plazo antes."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stop(self, timeout=10.0):
+        self.flush(timeout)
+        for _ in self._workers:
+            self._ready.put(None)
+
+    def _run(self):
+        while True:
+            chat_id = self._ready.get()
+            if chat_id is None:
+                return
+            self._service(chat_id)
+
+    def _service(self, chat_id):
+        batch, text, delay = self._begin(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            with TELEGRAM_SEND_SECONDS.time():
+                self.bot.send_message(chat_id, text, **batch[-1].kwargs)
+            self.sent += 1
+            done, retry_in = True, 0
+        except Exception as e:
+            done, retry_in = self._failed(chat_id, batch, e)
+        if retry_in:
+            time.sleep(retry_in)
+        self._finish(chat_id, batch, done)
+
+    def _begin(self, chat_id):
+        """Saca el siguiente lote del chat; devuelve (lote, texto, segundos que hay que esperar)."""
+        with self._lock:
+            batch = self._take_batch(self._chats[chat_id])
+        delay = max(self._next_send.get(chat_id, 0) - time.monotonic(), self.global_bucket.reserve())
+        TELEGRAM_MERGED.inc(len(batch) - 1)
+        return batch, "\n\n".join(m.text for m in batch), delay
+
+    def _failed(self, chat_id, batch, error):
+        """Clasifica un error de envío; devuelve (descartar el lote, segundos antes de reintentar)."""
+        if isinstance(error, ApiTelegramException):
+            TELEGRAM_SEND_ERRORS.inc(code=error.error_code)
+            retry_in = self._retry_delay(chat_id, batch, error)
+            return retry_in is None, retry_in or 0
+        TELEGRAM_SEND_ERRORS.inc(code='network')
+        # Errores de red: se reintenta con backoff exponencial
+        logging.warning(f"Error de red enviando a {chat_id}: {error}")
+        message = batch[-1]
+        message.attempts += 1
+        if message.attempts >= self.max_attempts:
+            logging.error(f"No se pudo enviar mensaje a {chat_id} tras {message.attempts} intentos.")
+            self.failed += 1
+            return True, 0
+        return False, self.retry_backoff * 2 ** (message.attempts - 1)
+
+    def _finish(self, chat_id, batch, done):
+        self._next_send[chat_id] = time.monotonic() + self.per_chat_interval
+        with self._lock:
+            messages = self._chats[chat_id]
+            if done:
+                self._pending -= len(batch)
+            else:
+                messages.extendleft(reversed(batch))
+            if messages:
+                self._wake(chat_id)
+            else:
+                del self._chats[chat_id]
+                if self._pending == 0:
+                    self._idle.notify_all()
+
+    def _take_batch(self, messages):
+        """Saca el siguiente mensaje junto con los mensajes de texto plano que lo preceden."""
+        batch = [messages.popleft()]
+        length = len(batch[0].text)
+        while messages and not batch[-1].kwargs.get('reply_markup'):
+            nxt = messages[0]
+            if nxt.kwargs.get('parse_mode') != batch[0].kwargs.get('parse_mode'):
+                break
+            length += len(nxt.text) + 2
+            if length > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(messages.popleft())
+        return batch
+
+    def _retry_delay(self, chat_id, batch, error):
+        """Segundos de espera antes de reintentar tras un error de la API, o None si no se reintenta."""
+        message = batch[-1]
+        if error.error_code == 429:
+            retry_after = (error.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            logging.warning(f"Límite de Telegram alcanzado para {chat_id}. Reintento en {retry_after} s")
+            return retry_after
+        message.attempts += 1
+        if error.error_code >= 500 and message.attempts < self.max_attempts:
+            return self.retry_backoff * 2 ** (message.attempts - 1)
+        logging.error(f"No se pudo enviar mensaje a {chat_id}: {error}")
+        self.failed += 1
+        return None
+
+
+class AsyncTelegramOutbox(TelegramOutbox):
+    """Cola de salida para AsyncTeleBot: los workers son tareas del bucle de eventos, no hilos.
+
+    `send_message` se puede seguir llamando desde cualquier hilo. Los mensajes encolados antes
+    de `start()` se envían al arrancar.
+    """
+
+    def _start_workers(self, workers):
+        self._worker_count = workers
+        self._workers = []
+        self._loop = None
+        self._early = []  # chats listos antes de que exista el bucle
+
+    def start(self):
+        """Se llama desde el bucle de eventos; arranca los workers."""
+        loop = asyncio.get_running_loop()
+        self._ready = asyncio.Queue()
+        with self._lock:
+            self._loop = loop
+            early, self._early = self._early, []
+        for chat_id in early:
+            self._ready.put_nowait(chat_id)
+        self._workers = [loop.create_task(self._run_async(), name=f"telegram-outbox-{i}")
+                         for i in range(self._worker_count)]
+
+    def _wake(self, chat_id):
+        if self._loop is None:
+            self._early.append(chat_id)
+        else:
+            self._loop.call_soon_threadsafe(self._ready.put_nowait, chat_id)
+
+    async def _run_async(self):
+        while True:
+            chat_id = await self._ready.get()
+            await self._service_async(chat_id)
+
+    async def _service_async(self, chat_id):
+        batch, text, delay = self._begin(chat_id)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            with TELEGRAM_SEND_SECONDS.time():
+                await self.bot.send_message(chat_id, text, **batch[-1].kwargs)
+            self.sent += 1
+            done, retry_in = True, 0
+        except Exception as e:
+            done, retry_in = self._failed(chat_id, batch, e)
+        if retry_in:
+            await asyncio.sleep(retry_in)
+        self._finish(chat_id, batch, done)
+
+    def stop(self, timeout=10.0):
+        for worker in self._workers:
+            worker.cancel()
+
+    async def aclose(self, timeout=10.0):
+        """Espera (sin bloquear el bucle) a que se vacíe la cola y detiene los workers."""
+        await asyncio.to_thread(self.flush, timeout)
+        self.stop()
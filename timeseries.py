@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:  # numpy es opcional: sin él las consultas se calculan en Python puro
+    np = None
+
+
+class RingBuffer:
+    """Buffer circular de capacidad fija con una columna `array('d')` por campo más el timestamp.
+
+    Los timestamps deben llegar en orden creciente, así las consultas por rango son búsquedas
+    binarias sobre la vista ordenada.
+    """
+
+    def __init__(self, capacity, columns=('value',)):
+        self.capacity = capacity
+        self.columns = columns
+        self.times = array('d', bytes(8 * capacity))
+        self.data = {c: array('d', bytes(8 * capacity)) for c in columns}
+        self.head = 0  # Próxima posición a escribir
+        self.count = 0
+
+    def append(self, ts, *values):
+        i = self.head
+        self.times[i] = ts
+        for column, value in zip(self.columns, values):
+            self.data[column][i] = value
+        self.head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def oldest(self):
+        if not self.count:
+            return None
+        return self.times[(self.head - self.count) % self.capacity]
+
+    def _ordered(self, column):
+        if self.count < self.capacity:
+            return column[:self.count]
+        return column[self.head:] + column[:self.head]
+
+    def window(self, start, end):
+        """Devuelve (timestamps, {columna: valores}) de las muestras con start <= ts <= end."""
+        times = self._ordered(self.times)
+        lo, hi = bisect_left(times, start), bisect_right(times, end)
+        return times[lo:hi], {c: self._ordered(self.data[c])[lo:hi] for c in self.columns}
+
+
+class _Bucket:
+    __slots__ = ('key', 'total', 'count', 'min', 'max')
+
+    def __init__(self, key):
+        self.key = key
+        self.total = 0.0
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, total, count, low, high):
+        self.total += total
+        self.count += count
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+
+class Series:
+    """Historial de una variable de un dispositivo en tres niveles: crudo, por minuto y por hora.
+
+    Cada muestra va al buffer crudo; al cerrarse un minuto (o una hora) su agregado
+    (media, mínimo, máximo, cantidad) pasa al nivel siguiente. La memoria es fija.
+    """
+
+    AGGREGATE_COLUMNS = ('mean', 'min', 'max', 'count')
+
+    def __init__(self, raw_capacity=3600, minute_capacity=1440, hour_capacity=24 * 30):
+        self.raw = RingBuffer(raw_capacity)
+        self.minutes = RingBuffer(minute_capacity, self.AGGREGATE_COLUMNS)
+        self.hours = RingBuffer(hour_capacity, self.AGGREGATE_COLUMNS)
+        self._minute = None
+        self._hour = None
+        self._lock = threading.Lock()
+
+    def append(self, ts, value):
+        value = float(value)
+        with self._lock:
+            if self.raw.count and ts < self.raw.times[(self.raw.head - 1) % self.raw.capacity]:
+                return  # Muestra fuera de orden
+            self.raw.append(ts, value)
+
+            key = int(ts // 60)
+            if self._minute is not None and self._minute.key != key:
+                self._close_minute()
+            if self._minute is None:
+                self._minute = _Bucket(key)
+            self._minute.add(value, 1, value, value)
+
+    def _close_minute(self):
+        b = self._minute
+        self.minutes.append(b.key * 60, b.total / b.count, b.min, b.max, b.count)
+        self._minute = None
+
+        key = b.key // 60
+        if self._hour is not None and self._hour.key != key:
+            h = self._hour
+            self.hours.append(h.key * 3600, h.total / h.count, h.min, h.max, h.count)
+            self._hour = None
+        if self._hour is None:
+            self._hour = _Bucket(key)
+        self._hour.add(b.total, b.count, b.min, b.max)
+
+    def stats(self, start, end, percentiles=(50, 95)):
+        """Resumen del rango combinando niveles. None si no hay datos.
+
+        La parte reciente sale del nivel más fino que la conserva y la más antigua de los
+        niveles agregados; cada nivel aporta solo lo anterior a donde empieza el más fino, con el
+        corte alineado a sus cubetas para no contar dos veces. Los minutos y horas aún abiertos
+        cuentan como una cubeta más de su nivel.
+        """
+        parts = []
+        with self._lock:
+            tiers = ((self.raw, None, 60), (self.minutes, self._minute, 3600), (self.hours, self._hour, None))
+            upper = float('inf')  # Lo posterior ya lo cubre un nivel más fino
+            for tier, open_bucket, next_width in tiers:
+                times, columns = tier.window(start, end)
+                if tier is self.raw:
+                    values = columns['value']
+                    entries = (values, values, values, array('d', [1.0]) * len(values))
+                else:
+                    entries = tuple(columns[c] for c in self.AGGREGATE_COLUMNS)
+                    width = 60 if open_bucket is self._minute else 3600
+                    if open_bucket is not None and start <= open_bucket.key * width <= end:
+                        times = times + array('d', [open_bucket.key * width])
+                        b = open_bucket
+                        entries = tuple(column + array('d', [v]) for column, v in
+                                        zip(entries, (b.total / b.count, b.min, b.max, b.count)))
+
+                oldest = tier.oldest()
+                if open_bucket is not None and (oldest is None or open_bucket.key * width < oldest):
+                    oldest = open_bucket.key * width
+                if oldest is None:
+                    continue
+                covers_start = oldest <= start or next_width is None
+                cut = float('-inf') if covers_start else -(-oldest // next_width) * next_width
+                lo, hi = bisect_left(times, cut), bisect_left(times, upper)
+                if hi > lo:
+                    parts.append((tier, tuple(column[lo:hi] for column in entries)))
+                if covers_start:
+                    break
+                upper = cut
+
+        if not parts:
+            return None
+        if len(parts) == 1 and parts[0][0] is self.raw:
+            values = parts[0][1][0]  # Solo datos crudos
+            return _summary(values, values, values, None, percentiles)
+        values, lows, highs, counts = (sum((entries[i] for _, entries in reversed(parts)), array('d'))
+                                       for i in range(4))
+        return _summary(values, lows, highs, counts, percentiles)
+
+
+def _summary(values, lows, highs, counts, percentiles):
+    if np is not None:
+        v = np.frombuffer(values, dtype=np.float64)
+        mean = float(np.average(v, weights=np.frombuffer(counts, dtype=np.float64) if counts else None))
+        result = {
+            'count': int(np.sum(np.frombuffer(counts, dtype=np.float64))) if counts else len(v),
+            'min': float(np.min(np.frombuffer(lows, dtype=np.float64))),
+            'max': float(np.max(np.frombuffer(highs, dtype=np.float64))),
+            'mean': mean,
+        }
+        for p, q in zip(percentiles, np.percentile(v, percentiles)):
+            result[f'p{p}'] = float(q)
+        return result
+
+    if counts:
+        total = sum(counts)
+        mean = sum(v * c for v, c in zip(values, counts)) / total
+    else:
+        total = len(values)
+        mean = sum(values) / total
+    result = {'count': int(total), 'min': min(lows), 'max': max(highs), 'mean': mean}
+    ordered = sorted(values)
+    for p in percentiles:
+        result[f'p{p}'] = _percentile(ordered, p)
+    return result
+
+
+def _percentile(ordered, p):
+    """Percentil con interpolación lineal (el mismo criterio que numpy por defecto)."""
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class SeriesStore:
+    """Series por (dispositivo, variable), creadas al recibir la primera muestra."""
+
+    def __init__(self, **series_options):
+        self.series_options = series_options
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, device, variable, value, ts=None):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            logging.warning(f"Valor no numérico para {device}/{variable}: {value!r}")
+            return
+        key = (device, variable)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, Series(**self.series_options))
+        series.append(time.time() if ts is None else ts, value)
+
+    def stats(self, device, variable, seconds, end=None):
+        """Resumen de los últimos `seconds` segundos (hasta `end`, por defecto ahora)."""
+        series = self._series.get((device, variable))
+        if series is None:
+            return None
+        end = time.time() if end is None else end
+        return series.stats(end - seconds, end)
+
+    def variables(self, device=None):
+        return sorted({v for d, v in list(self._series) if device is None or d == device})